@@ -1,12 +1,18 @@
 from flask import request, jsonify
-import jwt
 from functools import wraps
+import hmac
+import os
+import tracing
+from resource_accounting import attribute, usage_accounting
 
 # 配置
 SECRET_KEY = 'your-secret-key-change-in-production'
+# 管理接口令牌，未设置时管理接口不可用
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
 
 def verify_token(token):
     """验证JWT令牌"""
+    import jwt  # 延迟导入，缩短冷启动时间
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
         return payload
@@ -25,7 +31,8 @@ def token_required(f):
         
         try:
             token = token.split(' ')[1]  # 移除 'Bearer ' 前缀
-            payload = verify_token(token)
+            with tracing.span('auth.verify_token'):
+                payload = verify_token(token)
             if not payload:
                 return jsonify({'error': '无效的访问令牌'}), 403
             
@@ -33,5 +40,24 @@ def token_required(f):
         except:
             return jsonify({'error': '无效的访问令牌'}), 403
         
+        # 计入用户的资源使用，超出配额时限流
+        user_id = request.current_user.get('user_id')
+        attribute(user_id)
+        retry_after = usage_accounting.retry_after(user_id)
+        if retry_after:
+            return jsonify({'error': '资源使用超出配额，请稍后重试'}), 429, {'Retry-After': str(retry_after)}
+        
+        return f(*args, **kwargs)
+    return decorated
+
+def admin_required(f):
+    """需要管理令牌（请求头 X-Admin-Token）的装饰器"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': '管理接口未启用'}), 404
+        token = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+            return jsonify({'error': '无效的管理令牌'}), 403
         return f(*args, **kwargs)
     return decorated
\ No newline at end of file
@@ -1,18 +1,35 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Header, Request, status
+from typing import Optional
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 from database import get_db, User
 from models import UserRegister, UserLogin, UserResponse, TokenResponse, ErrorResponse
-from auth_utils import hash_password, verify_password, create_access_token, get_current_user
+from auth_utils import hash_password, create_access_token, get_current_user
+from password_hashing import password_hasher
+from idempotency import fastapi_idempotent
+from resource_accounting import attribute
 from datetime import timedelta
 
 router = APIRouter(prefix="/api/auth", tags=["认证"])
 
 @router.post("/register", response_model=TokenResponse)
-async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
+async def register_user(
+    user_data: UserRegister,
+    request: Request,
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None)
+):
     """
     用户注册
+
+    带 Idempotency-Key 请求头时，重试返回第一次注册的响应，不会重复计算密码哈希
     """
+    if idempotency_key:
+        return await fastapi_idempotent(request, idempotency_key, None, lambda: _register(user_data, db))
+    return _register(user_data, db)
+
+def _register(user_data: UserRegister, db: Session) -> TokenResponse:
+    """创建用户并签发访问令牌"""
     # 验证密码长度
     if len(user_data.password) < 6:
         raise HTTPException(
@@ -50,6 +67,8 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
             detail="用户名或邮箱已存在"
         )
     
+    attribute(new_user.id)
+    
     # 创建访问令牌
     access_token = create_access_token(
         data={"user_id": new_user.id, "username": new_user.username}
@@ -78,12 +97,20 @@ async def login_user(user_data: UserLogin, db: Session = Depends(get_db)):
         )
     
     # 验证密码
-    if not verify_password(user_data.password, user.password):
+    valid, new_hash = password_hasher.verify_and_update(user_data.password, user.password)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="用户名或密码错误"
         )
     
+    attribute(user.id)
+    
+    # 工作因子过低的旧哈希换成新哈希
+    if new_hash:
+        user.password = new_hash
+        db.commit()
+    
     # 创建访问令牌
     access_token = create_access_token(
         data={"user_id": user.id, "username": user.username}
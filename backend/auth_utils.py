@@ -1,4 +1,3 @@
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
@@ -6,9 +5,9 @@ from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from database import get_db, User
-
-# 密码加密上下文
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from password_hashing import password_hasher
+from resource_accounting import attribute, usage_accounting
+import tracing
 
 # JWT配置
 SECRET_KEY = "your-secret-key-change-in-production"
@@ -20,11 +19,11 @@ security = HTTPBearer()
 
 # 密码哈希
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return password_hasher.hash(password)
 
 # 验证密码
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_hasher.verify(plain_password, hashed_password)
 
 # 创建访问令牌
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -55,7 +54,8 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     )
     
     try:
-        payload = verify_access_token(credentials.credentials)
+        with tracing.span('auth.verify_token'):
+            payload = verify_access_token(credentials.credentials)
         if payload is None:
             raise credentials_exception
         
@@ -66,8 +66,19 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     except JWTError:
         raise credentials_exception
     
-    user = db.query(User).filter(User.id == user_id).first()
+    with tracing.span('auth.load_user'):
+        user = db.query(User).filter(User.id == user_id).first()
     if user is None:
         raise credentials_exception
     
+    # 计入用户的资源使用，超出配额时限流
+    attribute(user.id)
+    retry_after = usage_accounting.retry_after(user.id)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="资源使用超出配额，请稍后重试",
+            headers={"Retry-After": str(retry_after)},
+        )
+    
     return user
\ No newline at end of file
@@ -0,0 +1,118 @@
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# 冷启动模式：Vercel 等 serverless 环境下默认开启，也可通过 COLD_START_MODE=1 显式开启
+COLD_START_MODE = os.environ.get('COLD_START_MODE', '1' if os.environ.get('VERCEL') else '0') == '1'
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_init_lock = threading.Lock()
+_initialized = set()
+_phase_timings = []
+
+@contextmanager
+def timed_phase(name):
+    """记录一个启动阶段的耗时（毫秒）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phase_timings.append((name, round((time.perf_counter() - start) * 1000, 3)))
+
+def schema_is_current(db_path, version):
+    """检查数据库的 schema 版本戳是否已是最新（只读取文件头，不执行 DDL）"""
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0] >= version
+    finally:
+        conn.close()
+
+def stamp_schema(conn, version):
+    """在 DDL 执行完成后写入 schema 版本戳"""
+    conn.execute(f'PRAGMA user_version = {int(version)}')
+
+def ensure_once(key, init_fn):
+    """每个进程只执行一次初始化（冷启动模式下由首个请求触发）"""
+    if key in _initialized:
+        return
+    with _init_lock:
+        if key in _initialized:
+            return
+        with timed_phase(f'init:{os.path.basename(key)}'):
+            init_fn()
+        _initialized.add(key)
+
+def get_cold_start_report():
+    """返回当前进程的冷启动阶段耗时"""
+    return {
+        'cold_start_mode': COLD_START_MODE,
+        'phases': [{'phase': name, 'ms': ms} for name, ms in _phase_timings],
+    }
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\| ( *)(.*)$')
+
+def profile_imports(module='flask_app', top=20, cold_start=True):
+    """在子进程中用 python -X importtime 导入模块，返回累计耗时最高的导入项"""
+    env = dict(os.environ)
+    env['COLD_START_MODE'] = '1' if cold_start else '0'
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    wall_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    entries = []
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append({
+                'module': name.strip(),
+                'depth': len(indent) // 2,
+                'self_ms': int(self_us) / 1000,
+                'cumulative_ms': int(cumulative_us) / 1000,
+            })
+
+    top_level = [e for e in entries if e['depth'] == 0]
+    return {
+        'module': module,
+        'cold_start_mode': cold_start,
+        'returncode': result.returncode,
+        'wall_ms': wall_ms,
+        'total_import_ms': round(sum(e['cumulative_ms'] for e in top_level), 3),
+        'top': sorted(entries, key=lambda e: e['cumulative_ms'], reverse=True)[:top],
+        'error': result.stderr.strip().splitlines()[-1] if result.returncode else None,
+    }
+
+def print_import_report(report):
+    """打印导入耗时报告"""
+    mode = '冷启动模式' if report['cold_start_mode'] else '常规模式'
+    print(f"📦 导入 {report['module']}（{mode}）: 总导入耗时 {report['total_import_ms']:.1f} ms，进程耗时 {report['wall_ms']:.1f} ms")
+    if report['error']:
+        print(f"导入失败: {report['error']}")
+    print(f"{'cumulative(ms)':>15} {'self(ms)':>10}  module")
+    for entry in report['top']:
+        print(f"{entry['cumulative_ms']:>15.1f} {entry['self_ms']:>10.1f}  {'  ' * entry['depth']}{entry['module']}")
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='导入耗时分析（冷启动）')
+    parser.add_argument('--module', default='flask_app', help='要分析的模块')
+    parser.add_argument('--top', type=int, default=20, help='显示耗时最高的前N项')
+    parser.add_argument('--compare', action='store_true', help='同时对比常规模式')
+    args = parser.parse_args()
+
+    print_import_report(profile_imports(args.module, args.top, cold_start=True))
+    if args.compare:
+        print()
+        print_import_report(profile_imports(args.module, args.top, cold_start=False))
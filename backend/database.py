@@ -3,13 +3,21 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 import os
+from cold_start import COLD_START_MODE, schema_is_current, ensure_once
+import tracing
+import resource_accounting
 
 # 数据库文件路径
 DATABASE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database', 'users.db')
 DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
 
+# users表schema版本，与flask_app.py保持一致
+USERS_SCHEMA_VERSION = 1
+
 # 创建数据库引擎
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+tracing.instrument_sqlalchemy(engine)
+resource_accounting.instrument_sqlalchemy(engine)
 
 # 创建会话
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -28,14 +36,20 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-# 创建数据库表
-def create_tables():
+# 创建数据库表（schema版本已是最新时跳过）
+def create_tables(force=False):
     # 确保数据库目录存在
     os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+    if not force and schema_is_current(DATABASE_PATH, USERS_SCHEMA_VERSION):
+        return
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f'PRAGMA user_version = {USERS_SCHEMA_VERSION}')
 
 # 获取数据库会话
 def get_db():
+    if COLD_START_MODE:
+        ensure_once(DATABASE_PATH, create_tables)
     db = SessionLocal()
     try:
         yield db
@@ -0,0 +1,218 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from shard_router import all_shard_paths, SHARD_DIRECTORY_PATH
+from resource_accounting import USAGE_DATABASE_PATH
+
+# 数据库目录
+DATABASE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database')
+USERS_DATABASE_PATH = os.path.join(DATABASE_DIR, 'users.db')
+BACKUP_DIR = os.environ.get('DB_BACKUP_DIR', os.path.join(DATABASE_DIR, 'backups'))
+
+# 维护配置
+MAINTENANCE_INTERVAL_SECONDS = int(os.environ.get('DB_MAINTENANCE_INTERVAL_SECONDS', 6 * 3600))
+# 低负载时间窗口（本地小时，左闭右开），如 "2-5" 表示凌晨2点到5点
+MAINTENANCE_WINDOW = os.environ.get('DB_MAINTENANCE_WINDOW', '2-5')
+# 距离上一个请求超过该秒数才视为空闲
+MAINTENANCE_IDLE_SECONDS = int(os.environ.get('DB_MAINTENANCE_IDLE_SECONDS', 30))
+# 每次增量清理的最大页数
+VACUUM_PAGES = 1000
+# 在线备份每步复制的页数，以及步间暂停，避免长时间阻塞写入
+BACKUP_PAGES_PER_STEP = 64
+BACKUP_STEP_PAUSE_SECONDS = 0.005
+# 每个数据库保留的备份数
+BACKUP_KEEP = int(os.environ.get('DB_BACKUP_KEEP', 7))
+
+def get_database_paths():
+    """返回需要维护的数据库文件（用户库、所有todo分片、分片目录和用量统计库）"""
+    paths = [USERS_DATABASE_PATH] + all_shard_paths() + [SHARD_DIRECTORY_PATH]
+    if os.path.exists(USAGE_DATABASE_PATH):
+        paths.append(USAGE_DATABASE_PATH)
+    return paths
+
+def _connect(db_path):
+    return sqlite3.connect(db_path, timeout=5)
+
+def _run_task(task, db_path, fn):
+    """执行一个维护任务并记录耗时"""
+    start = time.perf_counter()
+    report = {'task': task, 'database': os.path.basename(db_path)}
+    try:
+        report['result'] = fn(db_path)
+        report['ok'] = True
+    except sqlite3.Error as e:
+        report['result'] = str(e)
+        report['ok'] = False
+    report['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    return report
+
+def optimize(db_path):
+    """更新查询规划器统计信息（没有统计信息时执行完整ANALYZE）"""
+    conn = _connect(db_path)
+    try:
+        has_stats = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ).fetchone()
+        if has_stats:
+            conn.execute('PRAGMA analysis_limit = 1000')
+            conn.execute('PRAGMA optimize')
+            return 'optimize'
+        conn.execute('ANALYZE')
+        return 'analyze'
+    finally:
+        conn.close()
+
+def incremental_vacuum(db_path, pages=VACUUM_PAGES):
+    """回收空闲页（需要数据库处于 auto_vacuum=INCREMENTAL 模式）"""
+    conn = _connect(db_path)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return 'skipped: auto_vacuum 未开启，请先执行 enable-incremental-vacuum'
+        free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        # executescript会把语句执行完，每一步释放一页
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+        free_after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return {'freed_pages': free_before - free_after, 'free_pages': free_after}
+    finally:
+        conn.close()
+
+def enable_incremental_vacuum(db_path):
+    """将已有数据库切换为 auto_vacuum=INCREMENTAL（需要执行一次完整VACUUM）"""
+    conn = _connect(db_path)
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    finally:
+        conn.close()
+
+def checkpoint(db_path, mode='PASSIVE'):
+    """执行WAL检查点，PASSIVE模式不会等待读写事务"""
+    conn = _connect(db_path)
+    try:
+        if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            return 'skipped: 非WAL模式'
+        busy, log_frames, checkpointed = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+        return {'busy': bool(busy), 'wal_frames': log_frames, 'checkpointed': checkpointed}
+    finally:
+        conn.close()
+
+def backup(db_path, backup_dir=BACKUP_DIR, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE_SECONDS):
+    """使用sqlite3备份API分步在线备份，步间释放锁，不阻塞写入"""
+    os.makedirs(backup_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    target = os.path.join(backup_dir, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    partial = target + '.partial'
+
+    steps = [0]
+    def progress(status, remaining, total):
+        steps[0] += 1
+
+    src = _connect(db_path)
+    dst = sqlite3.connect(partial)
+    try:
+        src.backup(dst, pages=pages, progress=progress, sleep=pause)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(partial, target)
+
+    # 只保留最近的若干份备份
+    existing = sorted(
+        f for f in os.listdir(backup_dir)
+        if f.startswith(f'{name}-') and f.endswith('.db')
+    )
+    for old in existing[:-BACKUP_KEEP]:
+        os.remove(os.path.join(backup_dir, old))
+
+    return {'file': target, 'steps': steps[0], 'bytes': os.path.getsize(target)}
+
+def run_maintenance(tasks=('optimize', 'vacuum', 'checkpoint', 'backup'), db_paths=None):
+    """对所有数据库依次执行维护任务，返回每个任务的耗时报告"""
+    handlers = {
+        'optimize': optimize,
+        'vacuum': incremental_vacuum,
+        'checkpoint': checkpoint,
+        'backup': backup,
+    }
+    reports = []
+    for db_path in db_paths or get_database_paths():
+        if not os.path.exists(db_path):
+            continue
+        for task in tasks:
+            reports.append(_run_task(task, db_path, handlers[task]))
+    return reports
+
+def print_reports(reports):
+    """打印维护报告"""
+    for report in reports:
+        status = '✅' if report['ok'] else '❌'
+        print(f"{status} {report['task']:<10} {report['database']:<12} {report['duration_ms']:>10.2f} ms  {report['result']}")
+
+def in_maintenance_window(now=None, window=MAINTENANCE_WINDOW):
+    """判断当前是否处于低负载时间窗口"""
+    if not window:
+        return True
+    start, end = (int(h) for h in window.split('-'))
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+class MaintenanceScheduler(threading.Thread):
+    """后台维护线程，在低负载时间窗口且服务空闲时执行维护任务"""
+
+    def __init__(self, interval=MAINTENANCE_INTERVAL_SECONDS, is_idle=None, retry_seconds=300):
+        super().__init__(name='db-maintenance', daemon=True)
+        self.interval = interval
+        self.is_idle = is_idle or (lambda: True)
+        self.retry_seconds = retry_seconds
+        self.stop_event = threading.Event()
+        self.last_reports = []
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if in_maintenance_window() and self.is_idle():
+                try:
+                    self.last_reports = run_maintenance()
+                    print("🧹 数据库维护完成")
+                    print_reports(self.last_reports)
+                except Exception as e:
+                    print(f"数据库维护出错: {e}")
+                self.stop_event.wait(self.interval)
+            else:
+                self.stop_event.wait(self.retry_seconds)
+
+    def stop(self):
+        self.stop_event.set()
+
+_scheduler = None
+
+def start_maintenance_scheduler(is_idle=None):
+    """启动后台维护线程（每个进程一个）"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = MaintenanceScheduler(is_idle=is_idle)
+        _scheduler.start()
+    return _scheduler
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='SQLite数据库维护')
+    parser.add_argument('task', choices=['optimize', 'vacuum', 'checkpoint', 'backup', 'all', 'enable-incremental-vacuum'])
+    parser.add_argument('--database', action='append', help='数据库文件路径，可多次指定（默认全部）')
+    args = parser.parse_args()
+
+    if args.task == 'enable-incremental-vacuum':
+        reports = [
+            _run_task(args.task, path, enable_incremental_vacuum)
+            for path in args.database or get_database_paths() if os.path.exists(path)
+        ]
+    elif args.task == 'all':
+        reports = run_maintenance(db_paths=args.database)
+    else:
+        reports = run_maintenance(tasks=(args.task,), db_paths=args.database)
+    print_reports(reports)
@@ -1,24 +1,50 @@
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 import sqlite3
-import bcrypt
-import jwt
 import os
+import time
 from datetime import datetime, timedelta
-from auth_decorators import token_required
+from auth_decorators import token_required, admin_required
+from idempotency import idempotent
+from password_hashing import password_hasher
+from cold_start import COLD_START_MODE, schema_is_current, stamp_schema, ensure_once, get_cold_start_report
+import tracing
+import resource_accounting
 
 app = Flask(__name__)
 CORS(app)
+tracing.init_flask(app)
+resource_accounting.init_flask(app)
 
 # 配置
 SECRET_KEY = 'your-secret-key-change-in-production'
 DATABASE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database', 'users.db')
 
+# users表schema版本，与database.py保持一致
+USERS_SCHEMA_VERSION = 1
+
 # 确保数据库目录存在
 os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
 
-def init_db():
-    """初始化数据库"""
+# 最近一次请求的时间，用于判断服务是否空闲
+_last_request_at = time.monotonic()
+
+@app.before_request
+def track_last_request():
+    """记录请求时间"""
+    global _last_request_at
+    _last_request_at = time.monotonic()
+
+def is_idle():
+    """距离上一个请求足够久时视为空闲"""
+    from db_maintenance import MAINTENANCE_IDLE_SECONDS
+    return time.monotonic() - _last_request_at > MAINTENANCE_IDLE_SECONDS
+
+def init_db(force=False):
+    """初始化数据库（schema版本已是最新时跳过DDL）"""
+    if not force and schema_is_current(DATABASE_PATH, USERS_SCHEMA_VERSION):
+        return
+    
     conn = sqlite3.connect(DATABASE_PATH)
     cursor = conn.cursor()
     
@@ -33,26 +59,30 @@ def init_db():
         )
     ''')
     
+    stamp_schema(conn, USERS_SCHEMA_VERSION)
     conn.commit()
     conn.close()
     print("数据库初始化完成")
 
 def get_db_connection():
     """获取数据库连接"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    if COLD_START_MODE:
+        ensure_once(DATABASE_PATH, init_db)
+    conn = resource_accounting.connect(DATABASE_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
 def hash_password(password):
     """加密密码"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return password_hasher.hash(password)
 
 def verify_password(password, hashed):
     """验证密码"""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    return password_hasher.verify(password, hashed)
 
 def create_token(user_id, username):
     """创建JWT令牌"""
+    import jwt  # 延迟导入，缩短冷启动时间
     payload = {
         'user_id': user_id,
         'username': username,
@@ -62,6 +92,7 @@ def create_token(user_id, username):
 
 def verify_token(token):
     """验证JWT令牌"""
+    import jwt
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
         return payload
@@ -95,7 +126,13 @@ def health_check():
     """健康检查"""
     return jsonify({'status': 'OK', 'message': '服务器运行正常'})
 
+@app.route('/api/health/cold-start')
+def cold_start_report():
+    """冷启动各阶段耗时"""
+    return jsonify(get_cold_start_report())
+
 @app.route('/api/auth/register', methods=['POST'])
+@idempotent
 def register():
     """用户注册"""
     data = request.get_json()
@@ -131,6 +168,7 @@ def register():
     
     user_id = cursor.lastrowid
     conn.commit()
+    resource_accounting.attribute(user_id)
     
     # 获取用户信息
     user = conn.execute(
@@ -173,9 +211,23 @@ def login():
         (username, username)
     ).fetchone()
     
-    if not user or not verify_password(password, user['password']):
+    if not user:
+        conn.close()
+        return jsonify({'detail': '用户名或密码错误'}), 401
+    
+    valid, new_hash = password_hasher.verify_and_update(password, user['password'])
+    if not valid:
         conn.close()
         return jsonify({'detail': '用户名或密码错误'}), 401
+    resource_accounting.attribute(user['id'])
+    
+    # 工作因子过低的旧哈希换成新哈希（其他请求已修改过密码时不覆盖）
+    if new_hash:
+        conn.execute(
+            'UPDATE users SET password = ? WHERE id = ? AND password = ?',
+            (new_hash, user['id'], user['password'])
+        )
+        conn.commit()
     
     conn.close()
     
@@ -216,12 +268,60 @@ def get_profile():
         'created_at': user['created_at']
     })
 
+@app.route('/api/admin/usage/top')
+@admin_required
+def get_usage_top():
+    """按资源使用排名的用户（需要 X-Admin-Token）"""
+    metric = request.args.get('metric', 'sql_ms')
+    if metric not in resource_accounting.USAGE_METRICS:
+        return jsonify({'detail': f"metric 必须是 {', '.join(resource_accounting.USAGE_METRICS)} 之一"}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    days = min(max(request.args.get('days', 1, type=int), 1), resource_accounting.MAX_USAGE_DAYS)
+    
+    users = resource_accounting.usage_accounting.top(metric, limit, days)
+    if users:
+        conn = get_db_connection()
+        placeholders = ', '.join('?' for _ in users)
+        names = dict(conn.execute(
+            f'SELECT id, username FROM users WHERE id IN ({placeholders})',
+            [u['user_id'] for u in users]
+        ).fetchall())
+        conn.close()
+        for u in users:
+            u['username'] = names.get(u['user_id'])
+    
+    return jsonify({
+        'metric': metric,
+        'days': days,
+        'users': users,
+        'throttled': resource_accounting.usage_accounting.throttled,
+    })
+
 # 注册todo蓝图
 from todo_routes import todo_bp
 app.register_blueprint(todo_bp)
 
 if __name__ == '__main__':
     init_db()
+    
+    # 启动后台归档线程
+    from todo_archive import start_archive_worker
+    start_archive_worker()
+    
+    # 启动后台数据库维护线程
+    from db_maintenance import start_maintenance_scheduler
+    start_maintenance_scheduler(is_idle=is_idle)
+    
+    # 启动到期提醒线程
+    from reminder_scheduler import start_reminder_scheduler
+    start_reminder_scheduler()
+    
+    # 启动后台用量写入线程
+    resource_accounting.start_usage_flusher()
+    
+    # 启动时校准bcrypt工作因子，避免首个登录请求承担校准耗时
+    print(f"bcrypt 工作因子: {password_hasher.rounds}")
+    
     print("🚀 Flask服务器启动成功！")
     print("🌐 前端页面地址: http://127.0.0.1:8000")
     print("📖 API健康检查: http://127.0.0.1:8000/api/health")
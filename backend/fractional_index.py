@@ -0,0 +1,71 @@
+"""分数排序键
+
+排序键是 base62 字符串，按字节序比较，可以看作 0.xxx 形式的62进制小数。
+任意两个键之间总能生成一个新键，因此移动一个元素只需要修改它自己的一行。
+键不以 '0' 结尾，保证在任意键之前也总能插入新键。
+"""
+
+DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+BASE = len(DIGITS)
+_INDEX = {d: i for i, d in enumerate(DIGITS)}
+
+def _midpoint(a, b):
+    """生成严格位于 a 与 b 之间的键，b 为 None 表示没有上界"""
+    if b is not None:
+        # 跳过公共前缀（a 较短时按补 '0' 比较）
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else '0') == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+
+    digit_a = _INDEX[a[0]] if a else 0
+    digit_b = _INDEX[b[0]] if b is not None else BASE
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b) // 2]
+    # 首位相邻：b 较长时取 b 的首位即可，否则在 a 之后继续细分
+    if b is not None and len(b) > 1:
+        return b[0]
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
+
+def key_between(a, b):
+    """生成位于 a 与 b 之间的键，a/b 为 None 表示列表头/尾"""
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f'{a!r} 必须小于 {b!r}')
+    if a is None and b is not None:
+        return key_before(b)
+    if a is not None and b is None:
+        return key_after(a)
+    return _midpoint(a or '', b)
+
+def key_after(a):
+    """生成比 a 大的键（末位加一，键长增长缓慢）"""
+    last = _INDEX[a[-1]]
+    if last < BASE - 1:
+        return a[:-1] + DIGITS[last + 1]
+    return a + DIGITS[BASE // 2]
+
+def key_before(b):
+    """生成比 b 小的键（末位减一，键长增长缓慢）"""
+    last = _INDEX[b[-1]]
+    if last > 1:
+        return b[:-1] + DIGITS[last - 1]
+    return b[:-1] + '0' + DIGITS[BASE // 2]
+
+def evenly_spaced_keys(count):
+    """为 count 个元素生成等间距的定长键，用于重新平衡"""
+    length = 1
+    while BASE ** length < (count + 1) * BASE:
+        length += 1
+    step = BASE ** length // (count + 1)
+
+    keys = []
+    for i in range(1, count + 1):
+        value = step * i
+        digits = []
+        for _ in range(length):
+            value, remainder = divmod(value, BASE)
+            digits.append(DIGITS[remainder])
+        # 去掉末尾的 '0' 不改变键的顺序
+        keys.append(''.join(reversed(digits)).rstrip('0'))
+    return keys
@@ -0,0 +1,209 @@
+"""Idempotency-Key 支持
+
+客户端在写请求上带 Idempotency-Key 请求头后，同一用户、同一接口、同一个key的请求只执行一次：
+- 第一次请求执行期间，并发的重复请求等待它完成
+- 完成后的重试直接返回保存的响应（响应头 Idempotent-Replayed: true），不再执行
+- 同一个key用于请求体不同的请求时返回 422
+- 5xx 或异常不保存，重试会重新执行
+
+记录保存在进程内存中，按 IDEMPOTENCY_TTL_SECONDS 过期、按 IDEMPOTENCY_MAX_ENTRIES 淘汰最早的已完成记录；
+多进程部署时重试可能落到其他进程，只能保证同一进程内的幂等。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 3600))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 10000))
+# 重复请求等待原请求完成的最长时间（秒）
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 30))
+MAX_KEY_LENGTH = 255
+
+class _Entry:
+    """一个key的处理状态，response 为 None 表示仍在处理中"""
+
+    __slots__ = ('fingerprint', 'event', 'response', 'expires_at')
+
+    def __init__(self, fingerprint, expires_at):
+        self.fingerprint = fingerprint
+        self.event = threading.Event()
+        self.response = None
+        self.expires_at = expires_at
+
+class IdempotencyStore:
+    """有界、按TTL过期的幂等记录（线程安全）"""
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL_SECONDS, max_entries=IDEMPOTENCY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (scope, key) -> _Entry，按创建时间排序，TTL相同因此也按过期时间排序
+        self._entries = OrderedDict()
+        self.executed = 0
+        self.replayed = 0
+        self.waited = 0
+
+    def _evict(self, now):
+        """淘汰过期记录，超出数量上限时从最早的开始淘汰（调用方持有锁）
+
+        处理中的记录不淘汰，否则原请求完成前到达的重试会再次执行；
+        处理中的记录数受并发请求数限制，全部处理中时允许暂时超出上限
+        """
+        excess = len(self._entries) - self.max_entries
+        evicted = []
+        for key, entry in self._entries.items():
+            if entry.expires_at > now and excess <= 0:
+                break
+            if entry.response is None:
+                continue
+            evicted.append(key)
+            excess -= 1
+        for key in evicted:
+            del self._entries[key]
+
+    def begin(self, scope, key, fingerprint):
+        """返回 (状态, 记录)，状态为 new（由调用方执行）、replay、in_progress 或 mismatch"""
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.get((scope, key))
+            if entry is None:
+                entry = self._entries[(scope, key)] = _Entry(fingerprint, now + self.ttl)
+                self._evict(now)
+                self.executed += 1
+                return 'new', entry
+            if entry.fingerprint != fingerprint:
+                return 'mismatch', entry
+            if entry.response is not None:
+                self.replayed += 1
+                return 'replay', entry
+            self.waited += 1
+            return 'in_progress', entry
+
+    def complete(self, scope, key, entry, status, body, content_type):
+        """保存最终响应并唤醒等待的重复请求"""
+        entry.response = (status, body, content_type)
+        entry.event.set()
+
+    def abort(self, scope, key, entry):
+        """执行失败时删除记录，等待的请求和之后的重试会重新执行"""
+        with self._lock:
+            if self._entries.get((scope, key)) is entry:
+                del self._entries[(scope, key)]
+        entry.event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'executed': self.executed,
+                'replayed': self.replayed,
+                'waited': self.waited,
+            }
+
+idempotency_store = IdempotencyStore()
+
+def request_fingerprint(method, path, body):
+    """请求的指纹，同一个key只能用于指纹相同的请求"""
+    digest = hashlib.sha256()
+    digest.update(f'{method} {path}\n'.encode('utf-8'))
+    digest.update(body or b'')
+    return digest.hexdigest()
+
+def idempotent(f):
+    """Flask写接口的幂等装饰器（放在 token_required 之后，以便按用户区分key）"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        from flask import request, jsonify, make_response
+
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({'detail': f'Idempotency-Key 长度不能超过 {MAX_KEY_LENGTH}'}), 400
+
+        user = getattr(request, 'current_user', None)
+        scope = (request.path, user['user_id'] if user else None)
+        fingerprint = request_fingerprint(request.method, request.path, request.get_data())
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+
+        while True:
+            state, entry = idempotency_store.begin(scope, key, fingerprint)
+            if state == 'mismatch':
+                return jsonify({'detail': '同一个 Idempotency-Key 不能用于不同的请求'}), 422
+            if state == 'replay':
+                status, body, content_type = entry.response
+                response = make_response(body, status)
+                response.content_type = content_type
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            if state == 'new':
+                break
+            # 原请求仍在处理中：等待它完成后再次检查（原请求失败时由本请求执行）
+            if not entry.event.wait(max(deadline - time.monotonic(), 0)):
+                return jsonify({'detail': '相同 Idempotency-Key 的请求仍在处理中，请稍后重试'}), 409
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except BaseException:
+            idempotency_store.abort(scope, key, entry)
+            raise
+        if response.status_code >= 500:
+            idempotency_store.abort(scope, key, entry)
+        else:
+            idempotency_store.complete(scope, key, entry, response.status_code,
+                                       response.get_data(), response.content_type)
+        return response
+    return decorated
+
+async def fastapi_idempotent(request, key, user_id, execute):
+    """FastAPI路由的幂等执行：execute 为同步函数，返回值按JSON保存；HTTPException(4xx) 也会保存"""
+    from fastapi import HTTPException, status
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import Response
+    from starlette.concurrency import run_in_threadpool
+
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Idempotency-Key 长度不能超过 {MAX_KEY_LENGTH}')
+
+    path = request.url.path
+    scope = (path, user_id)
+    fingerprint = request_fingerprint(request.method, path, await request.body())
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+
+    while True:
+        state, entry = idempotency_store.begin(scope, key, fingerprint)
+        if state == 'mismatch':
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail='同一个 Idempotency-Key 不能用于不同的请求')
+        if state == 'replay':
+            status_code, body, content_type = entry.response
+            return Response(content=body, status_code=status_code, media_type=content_type,
+                            headers={'Idempotent-Replayed': 'true'})
+        if state == 'new':
+            break
+        # 在线程池中等待，不阻塞事件循环
+        if not await run_in_threadpool(entry.event.wait, max(deadline - time.monotonic(), 0)):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail='相同 Idempotency-Key 的请求仍在处理中，请稍后重试')
+
+    try:
+        result = execute()
+    except HTTPException as e:
+        if e.status_code < 500:
+            body = json.dumps({'detail': e.detail}, ensure_ascii=False).encode('utf-8')
+            idempotency_store.complete(scope, key, entry, e.status_code, body, 'application/json')
+        else:
+            idempotency_store.abort(scope, key, entry)
+        raise
+    except BaseException:
+        idempotency_store.abort(scope, key, entry)
+        raise
+    body = json.dumps(jsonable_encoder(result), ensure_ascii=False).encode('utf-8')
+    idempotency_store.complete(scope, key, entry, 200, body, 'application/json')
+    return result
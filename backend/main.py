@@ -4,6 +4,10 @@ from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from auth_routes import router as auth_router
 from database import create_tables
+from cold_start import COLD_START_MODE
+from password_hashing import password_hasher
+import tracing
+import resource_accounting
 import os
 
 # 创建FastAPI应用
@@ -22,8 +26,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 创建数据库表
-create_tables()
+# 请求追踪（TRACE_SAMPLE_RATE 控制采样率）
+tracing.init_fastapi(app)
+resource_accounting.init_fastapi(app)
+
+# 创建数据库表（冷启动模式下推迟到首次获取会话时）
+if not COLD_START_MODE:
+    create_tables()
 
 # 注册路由
 app.include_router(auth_router)
@@ -49,6 +58,9 @@ async def health_check():
 # 启动信息
 @app.on_event("startup")
 async def startup_event():
+    # 启动时校准bcrypt工作因子，避免首个登录请求承担校准耗时
+    print(f"bcrypt 工作因子: {password_hasher.rounds}")
+    resource_accounting.start_usage_flusher()
     print("🚀 FastAPI服务器启动成功！")
     print("📖 API文档地址: http://localhost:8000/docs")
     print("🌐 前端页面地址: http://localhost:8000")
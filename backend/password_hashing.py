@@ -0,0 +1,152 @@
+"""密码哈希（Flask 和 FastAPI 两个应用共用）
+
+bcrypt 的工作因子在进程启动后首次使用时按本机速度校准：单次哈希耗时不超过 BCRYPT_TARGET_MS，
+且不低于 BCRYPT_MIN_ROUNDS。设置 BCRYPT_ROUNDS 时直接使用该值、跳过校准（冷启动环境或需要全集群统一时）。
+登录验证成功后，工作因子低于当前值的旧哈希会用新的工作因子重新计算并保存。
+
+用法：
+    python backend/password_hashing.py benchmark     测试本机每核每秒可计算的哈希数
+    python backend/password_hashing.py calibrate     输出按 BCRYPT_TARGET_MS 校准的工作因子
+"""
+import math
+import os
+import threading
+import time
+import tracing
+
+# 单次哈希的目标耗时（毫秒）
+BCRYPT_TARGET_MS = float(os.environ.get('BCRYPT_TARGET_MS', 250))
+# 固定的工作因子，设置后不再校准
+BCRYPT_ROUNDS = int(os.environ['BCRYPT_ROUNDS']) if os.environ.get('BCRYPT_ROUNDS') else None
+BCRYPT_MIN_ROUNDS = int(os.environ.get('BCRYPT_MIN_ROUNDS', 10))
+BCRYPT_MAX_ROUNDS = 16
+# 校准时使用的工作因子，耗时足够测量又不拖慢启动
+CALIBRATION_ROUNDS = 8
+CALIBRATION_SAMPLES = 3
+# bcrypt 只使用密码的前72字节
+MAX_PASSWORD_BYTES = 72
+
+def _encode(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+def hash_cost(hashed):
+    """bcrypt 哈希中的工作因子，格式不正确时返回 None"""
+    parts = hashed.split('$') if hashed else []
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+def time_hash(rounds):
+    """在指定工作因子下计算一次哈希的耗时（毫秒）"""
+    import bcrypt  # 延迟导入，缩短冷启动时间
+    salt = bcrypt.gensalt(rounds)
+    start = time.perf_counter()
+    bcrypt.hashpw(b'calibration-password', salt)
+    return (time.perf_counter() - start) * 1000
+
+def calibrate_rounds(target_ms=BCRYPT_TARGET_MS):
+    """单次耗时不超过 target_ms 的最大工作因子（工作因子每加1耗时翻倍）"""
+    sample_ms = min(time_hash(CALIBRATION_ROUNDS) for _ in range(CALIBRATION_SAMPLES))
+    rounds = CALIBRATION_ROUNDS + math.floor(math.log2(target_ms / max(sample_ms, 0.001)))
+    return max(BCRYPT_MIN_ROUNDS, min(rounds, BCRYPT_MAX_ROUNDS))
+
+class PasswordHasher:
+    """bcrypt 密码哈希，工作因子首次使用时确定（线程安全）"""
+
+    def __init__(self, rounds=BCRYPT_ROUNDS, target_ms=BCRYPT_TARGET_MS):
+        self._rounds = rounds
+        self.target_ms = target_ms
+        self._lock = threading.Lock()
+
+    @property
+    def rounds(self):
+        if self._rounds is None:
+            with self._lock:
+                if self._rounds is None:
+                    with tracing.span('bcrypt.calibrate'):
+                        self._rounds = calibrate_rounds(self.target_ms)
+        return self._rounds
+
+    def hash(self, password):
+        import bcrypt
+        rounds = self.rounds
+        with tracing.span('bcrypt.hash'):
+            return bcrypt.hashpw(_encode(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+    def verify(self, password, hashed):
+        import bcrypt
+        with tracing.span('bcrypt.verify'):
+            try:
+                return bcrypt.checkpw(_encode(password), hashed.encode('utf-8'))
+            except ValueError:
+                # 不是合法的 bcrypt 哈希
+                return False
+
+    def needs_rehash(self, hashed):
+        """哈希的工作因子低于当前值时需要重新计算（只升级，不因校准结果变小而降级）"""
+        cost = hash_cost(hashed)
+        return cost is None or cost < self.rounds
+
+    def verify_and_update(self, password, hashed):
+        """验证密码，返回 (是否正确, 新哈希)；不需要重新计算时新哈希为 None"""
+        if not self.verify(password, hashed):
+            return False, None
+        if self.needs_rehash(hashed):
+            return True, self.hash(password)
+        return True, None
+
+password_hasher = PasswordHasher()
+
+def benchmark(rounds, seconds=3.0, workers=None):
+    """在 workers 个线程中持续计算哈希（bcrypt 计算时释放GIL），返回统计结果"""
+    from concurrent.futures import ThreadPoolExecutor
+    import bcrypt
+
+    workers = workers or os.cpu_count() or 1
+    salt = bcrypt.gensalt(rounds)
+
+    def run():
+        count = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            bcrypt.hashpw(b'benchmark-password', salt)
+            count += 1
+        return count
+
+    single = run()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        total = sum(executor.map(lambda _: run(), range(workers)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'rounds': rounds,
+        'cores': workers,
+        'ms_per_hash': round(seconds * 1000 / single, 2) if single else None,
+        'hashes_per_second_single_core': round(single / seconds, 2),
+        'hashes_per_second_total': round(total / elapsed, 2),
+        'hashes_per_second_per_core': round(total / elapsed / workers, 2),
+    }
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='bcrypt 工作因子校准与基准测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    benchmark_parser = subparsers.add_parser('benchmark', help='测试每核每秒可计算的哈希数')
+    benchmark_parser.add_argument('--rounds', type=int, help='工作因子（默认使用校准结果或 BCRYPT_ROUNDS）')
+    benchmark_parser.add_argument('--seconds', type=float, default=3.0, help='每轮测试时长（秒）')
+    benchmark_parser.add_argument('--workers', type=int, help='并发线程数（默认CPU核数）')
+    calibrate_parser = subparsers.add_parser('calibrate', help='按目标耗时校准工作因子')
+    calibrate_parser.add_argument('--target-ms', type=float, default=BCRYPT_TARGET_MS, help='单次哈希目标耗时（毫秒）')
+    args = parser.parse_args()
+
+    if args.command == 'calibrate':
+        rounds = calibrate_rounds(args.target_ms)
+        print(f"目标 {args.target_ms:g} ms，建议 BCRYPT_ROUNDS={rounds}（实测 {time_hash(rounds):.1f} ms）")
+    else:
+        result = benchmark(args.rounds or password_hasher.rounds, args.seconds, args.workers)
+        print(f"工作因子 {result['rounds']}，单次 {result['ms_per_hash']} ms")
+        print(f"单核 {result['hashes_per_second_single_core']} 次/秒，"
+              f"{result['cores']} 核合计 {result['hashes_per_second_total']} 次/秒，"
+              f"每核 {result['hashes_per_second_per_core']} 次/秒")
@@ -0,0 +1,281 @@
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from functools import wraps
+from cold_start import COLD_START_MODE
+from shard_router import DATABASE_DIR, shard_for_user, shard_directory
+
+# 缓存总内存上限（字节），设为0关闭缓存
+# 缓存位于进程内存中，多进程/serverless部署时各实例之间无法互相失效，因此冷启动模式下默认关闭
+# （命令行任务的写入通过 InvalidationLog 通知服务进程）
+QUERY_CACHE_MAX_BYTES = int(os.environ.get('QUERY_CACHE_MAX_BYTES', 0 if COLD_START_MODE else 32 * 1024 * 1024))
+# 每个用户最多缓存的查询结果数
+QUERY_CACHE_MAX_ENTRIES_PER_USER = int(os.environ.get('QUERY_CACHE_MAX_ENTRIES_PER_USER', 16))
+# 进程外写入（命令行归档等）的失效记录数据库
+CACHE_INVALIDATION_PATH = os.environ.get('CACHE_INVALIDATION_PATH', os.path.join(DATABASE_DIR, 'cache_invalidations.db'))
+# 失效记录保留时间，超过这段时间没有读取缓存的进程会清除全部缓存
+CACHE_INVALIDATION_RETENTION = '-1 day'
+
+def estimate_size(value):
+    """粗略估算查询结果占用的内存（字节）"""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+def freeze_key(value):
+    """把参数转换为可哈希的缓存键"""
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(freeze_key(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze_key(v)) for k, v in value.items()))
+    return value
+
+def copy_result(value):
+    """复制缓存的结果，避免调用方修改缓存内容"""
+    if isinstance(value, dict):
+        return {k: copy_result(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_result(v) for v in value]
+    return value
+
+class UserQueryCache:
+    """按用户分组的查询结果缓存，按LRU淘汰并统计内存占用（线程安全）"""
+
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, max_entries_per_user=QUERY_CACHE_MAX_ENTRIES_PER_USER):
+        self.max_bytes = max_bytes
+        self.max_entries_per_user = max_entries_per_user
+        self._lock = threading.Lock()
+        # user_id -> OrderedDict(key -> (value, size))，外层和内层都按最近使用排序
+        self._users = OrderedDict()
+        # 每次失效递增，防止失效前开始的查询把旧结果写回缓存
+        self._generations = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def get(self, user_id, key):
+        """命中返回 (True, value)，未命中返回 (False, None)"""
+        with self._lock:
+            entries = self._users.get(user_id)
+            if entries is not None and key in entries:
+                entries.move_to_end(key)
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return True, entries[key][0]
+            self.misses += 1
+            return False, None
+
+    def put(self, user_id, key, value, generation):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if self._generations.get(user_id, 0) != generation:
+                return
+            entries = self._users.setdefault(user_id, OrderedDict())
+            if key in entries:
+                self.current_bytes -= entries.pop(key)[1]
+            entries[key] = (value, size)
+            self._users.move_to_end(user_id)
+            self.current_bytes += size
+
+            while len(entries) > self.max_entries_per_user:
+                self._evict_one(user_id)
+            while self.current_bytes > self.max_bytes and self._users:
+                self._evict_one(next(iter(self._users)))
+
+    def _evict_one(self, user_id):
+        """淘汰某个用户最久未使用的一条结果（调用方持有锁）"""
+        entries = self._users[user_id]
+        _, (_, size) = entries.popitem(last=False)
+        self.current_bytes -= size
+        self.evictions += 1
+        if not entries:
+            del self._users[user_id]
+
+    def invalidate_user(self, user_id):
+        """用户数据发生写入时清除该用户的全部缓存"""
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            entries = self._users.pop(user_id, None)
+            if entries:
+                self.current_bytes -= sum(size for _, size in entries.values())
+            self.invalidations += 1
+
+    def invalidate_all(self):
+        """清除所有已缓存用户的结果并递增其代数"""
+        with self._lock:
+            user_ids = list(self._users)
+        for user_id in user_ids:
+            self.invalidate_user(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._generations.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'users': len(self._users),
+                'entries': sum(len(entries) for entries in self._users.values()),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+query_cache = UserQueryCache()
+
+class InvalidationLog:
+    """跨进程的缓存失效记录
+
+    命令行等进程外的写入把涉及的用户追加到失效记录库中。与分片目录相同，记录库使用回滚日志模式，
+    服务进程每次读缓存前只读取文件头中的修改计数器，有变化时才读取新增的记录并清除这些用户的缓存。
+    """
+
+    def __init__(self, path=CACHE_INVALIDATION_PATH):
+        self.path = path
+        # 为 True 时 invalidate_users 同时写入失效记录（由命令行入口开启）
+        self.publishing = False
+        self._lock = threading.Lock()
+        self._version = None
+        self._last_seq = None
+
+    def _file_version(self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(24)
+                return f.read(4)
+        except FileNotFoundError:
+            return None
+
+    def publish(self, user_ids):
+        """追加失效记录并清理过期的记录"""
+        if not user_ids:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS invalidations (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.executemany('INSERT INTO invalidations (user_id) VALUES (?)', [(u,) for u in user_ids])
+            conn.execute('''
+                DELETE FROM invalidations WHERE created_at < datetime('now', ?)
+            ''', (CACHE_INVALIDATION_RETENTION,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def poll(self):
+        """读取上次检查之后新增的失效记录，返回需要清除的用户id；记录已被清理时返回 None 表示全部清除"""
+        version = self._file_version()
+        with self._lock:
+            if version is None:
+                # 记录库尚未创建，之后写入的记录都需要处理
+                if self._last_seq is None:
+                    self._last_seq = 0
+                return []
+            if version == self._version:
+                return []
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, timeout=10)
+            try:
+                first, last = conn.execute('SELECT MIN(seq), MAX(seq) FROM invalidations').fetchone()
+                if self._last_seq is None:
+                    # 进程第一次检查时缓存为空，之前的记录都不需要处理
+                    user_ids = []
+                elif first is not None and first > self._last_seq + 1:
+                    user_ids = None
+                else:
+                    user_ids = [row[0] for row in conn.execute('''
+                        SELECT DISTINCT user_id FROM invalidations WHERE seq > ?
+                    ''', (self._last_seq,))]
+            except sqlite3.OperationalError:
+                return []
+            finally:
+                conn.close()
+            self._version = version
+            if last is not None:
+                self._last_seq = last
+            elif self._last_seq is None:
+                self._last_seq = 0
+            return user_ids
+
+invalidation_log = InvalidationLog()
+
+def sync_invalidations():
+    """处理其他进程写入的失效记录，在读取缓存或合并请求前调用"""
+    user_ids = invalidation_log.poll()
+    if user_ids is None:
+        query_cache.invalidate_all()
+        return
+    for user_id in user_ids:
+        query_cache.invalidate_user(user_id)
+
+def cached_query(name):
+    """缓存以 user_id 为第一个参数的读方法的结果"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(user_id, *args, **kwargs):
+            if not query_cache.enabled:
+                return f(user_id, *args, **kwargs)
+
+            sync_invalidations()
+            # 键中包含用户当前的分片：其他进程（reshard.py）迁移用户后不会读到迁移前的结果
+            key = (name, shard_for_user(user_id), freeze_key(args), freeze_key(kwargs))
+            hit, value = query_cache.get(user_id, key)
+            if hit:
+                return copy_result(value)
+
+            generation = query_cache.generation(user_id)
+            value = f(user_id, *args, **kwargs)
+            query_cache.put(user_id, key, value, generation)
+            return copy_result(value)
+        return wrapper
+    return decorator
+
+def invalidate_user(user_id):
+    """清除用户的缓存结果
+
+    缓存关闭时也递增用户的代数，合并请求（single_flight）以代数区分写入前后的计算
+    """
+    query_cache.invalidate_user(user_id)
+
+def invalidate_users(user_ids):
+    """清除多个用户的缓存结果；在命令行等进程外写入时同时通知服务进程"""
+    for user_id in user_ids:
+        query_cache.invalidate_user(user_id)
+    if invalidation_log.publishing:
+        invalidation_log.publish(list(user_ids))
+
+def invalidate_moved_users(user_ids):
+    """分片目录重新加载后清除被迁移用户的缓存，并递增代数使进行中的合并计算失效"""
+    for user_id in user_ids:
+        invalidate_user(user_id)
+
+shard_directory.add_listener(invalidate_moved_users)
@@ -0,0 +1,144 @@
+"""重复规则
+
+规则以JSON存储在todo上，例如:
+    {"freq": "daily", "interval": 1}
+    {"freq": "weekly", "interval": 2, "weekdays": [0, 2], "until": "2025-12-31"}
+    {"freq": "monthly", "interval": 1}
+weekdays 使用 0=周一 ... 6=周日；按月重复时，不存在的日期（如31号）取当月最后一天。
+"""
+import calendar
+import json
+from datetime import date, datetime, timedelta
+
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+# 单次请求允许展开的最大日期范围
+MAX_WINDOW_DAYS = 366
+# 重复间隔上限（天/周/月）
+MAX_INTERVAL = 366
+# 结束日期上限，给日期计算留出余量，避免超出 date 的表示范围
+MAX_UNTIL = date(9000, 12, 31)
+
+def parse_rule(rule):
+    """校验并规范化重复规则，不合法时抛出 ValueError"""
+    if isinstance(rule, str):
+        rule = json.loads(rule)
+    if not isinstance(rule, dict):
+        raise ValueError('重复规则必须是对象')
+
+    freq = rule.get('freq')
+    if freq not in FREQUENCIES:
+        raise ValueError('重复频率必须是 daily, weekly 或 monthly')
+
+    interval = rule.get('interval', 1)
+    if isinstance(interval, bool) or not isinstance(interval, int) or not 1 <= interval <= MAX_INTERVAL:
+        raise ValueError(f'重复间隔必须是 1 到 {MAX_INTERVAL} 之间的整数')
+
+    normalized = {'freq': freq, 'interval': interval}
+
+    if rule.get('weekdays') is not None:
+        weekdays = rule['weekdays']
+        if not isinstance(weekdays, list) or not all(
+            isinstance(d, int) and not isinstance(d, bool) and 0 <= d <= 6 for d in weekdays
+        ):
+            raise ValueError('weekdays 必须是取值 0-6 的列表')
+        if weekdays:
+            if freq != 'weekly':
+                raise ValueError('weekdays 只能用于每周重复')
+            normalized['weekdays'] = sorted(set(weekdays))
+
+    if rule.get('until'):
+        until = parse_date(rule['until'])
+        if until > MAX_UNTIL:
+            raise ValueError(f'结束日期不能晚于 {MAX_UNTIL.isoformat()}')
+        normalized['until'] = until.isoformat()
+
+    return normalized
+
+def parse_date(value):
+    """解析 YYYY-MM-DD 或ISO日期时间字符串中的日期部分"""
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).date()
+    except (ValueError, AttributeError):
+        raise ValueError('日期格式不正确')
+
+def _add_months(start, months):
+    year, month = divmod(start.month - 1 + months, 12)
+    year += start.year
+    month += 1
+    day = min(start.day, calendar.monthrange(year, month)[1])
+    return date(year, month, day)
+
+def occurrences(rule, start, window_start, window_end):
+    """生成 [window_start, window_end] 内的所有发生日期
+
+    start 为系列的第一次发生日期；直接跳到窗口附近开始计算，耗时只与窗口内的次数有关
+    """
+    try:
+        rule = parse_rule(rule)
+    except ValueError:
+        # 校验收紧前已保存的不合法规则（如超大的间隔）不再展开，避免该用户的列表和统计一直出错
+        return
+    start = parse_date(start)
+    window_start = max(parse_date(window_start), start)
+    window_end = parse_date(window_end)
+    if rule.get('until'):
+        window_end = min(window_end, parse_date(rule['until']))
+    if window_start > window_end:
+        return
+
+    try:
+        yield from _iter_occurrences(rule, start, window_start, window_end)
+    except (OverflowError, ValueError):
+        # 日期超出 date 的表示范围（如截止日期接近 9999 年），之后不会再有发生
+        return
+
+def _iter_occurrences(rule, start, window_start, window_end):
+    interval = rule['interval']
+    freq = rule['freq']
+
+    if freq == 'daily':
+        k = -(-(window_start - start).days // interval)
+        current = start + timedelta(days=k * interval)
+        while current <= window_end:
+            yield current
+            current += timedelta(days=interval)
+
+    elif freq == 'weekly':
+        weekdays = rule.get('weekdays') or [start.weekday()]
+        start_monday = start - timedelta(days=start.weekday())
+        week = (window_start - start_monday).days // 7
+        week -= week % interval
+        while True:
+            monday = start_monday + timedelta(weeks=week)
+            if monday > window_end:
+                break
+            for weekday in weekdays:
+                current = monday + timedelta(days=weekday)
+                if window_start <= current <= window_end:
+                    yield current
+            week += interval
+
+    else:
+        months = (window_start.year - start.year) * 12 + window_start.month - start.month
+        months = max(months - months % interval, 0)
+        while True:
+            current = _add_months(start, months)
+            if current > window_end:
+                break
+            if current >= window_start:
+                yield current
+            months += interval
+
+def is_occurrence(rule, start, day):
+    """判断某一天是否是该系列的一次发生"""
+    day = parse_date(day)
+    return any(True for _ in occurrences(rule, start, day, day))
+
+def occurrence_due_date(series_due_date, day):
+    """用发生日期替换系列截止时间的日期部分，保留时间部分"""
+    day = parse_date(day).isoformat()
+    if series_due_date and len(series_due_date) > 10:
+        return day + series_due_date[10:]
+    return day
@@ -0,0 +1,260 @@
+"""到期提醒调度器
+
+最小堆中只保存接下来 REMINDER_LOOKAHEAD_SECONDS 内的截止时间，窗口快用完时从各分片的
+部分索引（idx_todos_pending_due / idx_todos_pending_series）按范围加载下一段。
+TodoModel 写入后通过观察者接口通知调度器，新建或修改的截止时间落在已加载窗口内时立即入堆；
+过时的堆项采用惰性删除，提醒触发前再到数据库确认todo仍未完成且截止时间未变。
+
+提醒事件发送到可插拔的本地接收器：REMINDER_SINK=log（默认，打印）或 jsonl:<文件路径>。
+"""
+import heapq
+import itertools
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from todo_models import connect_todo_db, get_todo_db_connection, add_todo_observer
+from shard_router import all_shard_paths
+from recurrence import occurrences, occurrence_due_date
+
+# 每次加载的时间窗口（秒）
+REMINDER_LOOKAHEAD_SECONDS = int(os.environ.get('REMINDER_LOOKAHEAD_SECONDS', 3600))
+# 提前提醒的时间（秒），0 表示在截止时间提醒
+REMINDER_LEAD_SECONDS = int(os.environ.get('REMINDER_LEAD_SECONDS', 0))
+# 没有待触发提醒时的最长休眠时间（秒）
+REMINDER_MAX_SLEEP_SECONDS = 60
+REMINDER_SINK = os.environ.get('REMINDER_SINK', 'log')
+
+def parse_due(value):
+    """把 due_date 字符串解析为本地时间（不带时区），只有日期时视为当天0点"""
+    try:
+        due = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (ValueError, AttributeError):
+        return None
+    if due.tzinfo is not None:
+        due = due.astimezone().replace(tzinfo=None)
+    return due
+
+def format_bound(moment):
+    """范围查询的边界，与 due_date 按字符串比较"""
+    return moment.isoformat(timespec='seconds')
+
+class LogSink:
+    """把提醒打印到标准输出"""
+
+    def __call__(self, event):
+        print(f"提醒: 用户 {event['user_id']} 的任务「{event['title']}」将于 {event['due_date']} 到期")
+
+class JsonlSink:
+    """把提醒逐行追加到JSONL文件"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+def create_sink(spec=REMINDER_SINK):
+    """根据配置创建接收器：log 或 jsonl:<路径>"""
+    if spec.startswith('jsonl:'):
+        return JsonlSink(spec[len('jsonl:'):])
+    if spec == 'log':
+        return LogSink()
+    raise ValueError(f'不支持的提醒接收器: {spec}')
+
+class ReminderScheduler(threading.Thread):
+    """后台提醒线程，按截止时间从堆中取出到期的提醒发送到接收器"""
+
+    def __init__(self, sink=None, lookahead=REMINDER_LOOKAHEAD_SECONDS, lead=REMINDER_LEAD_SECONDS):
+        super().__init__(name='todo-reminder-scheduler', daemon=True)
+        self.sink = sink or create_sink()
+        self.lookahead = timedelta(seconds=lookahead)
+        self.lead = timedelta(seconds=lead)
+        self.stop_event = threading.Event()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        # 堆项为 (提醒时间, 序号, key)，key 为 ('todo', user_id, id) 或 ('occurrence', user_id, series_id, 日期)；
+        # todo id 只在分片内唯一，key 中带上 user_id 区分不同分片的todo
+        self._heap = []
+        self._counter = itertools.count()
+        # key -> (提醒时间, 事件)，堆中提醒时间与此不一致的项已过时
+        self._scheduled = {}
+        # 已加载并入堆的提醒时间范围为 (_loaded_from, _loaded_until]
+        self._loaded_from = None
+        self._loaded_until = None
+        self.fired = 0
+        self.skipped = 0
+
+    def _entries(self, user_id, todo, window_start, window_end):
+        """todo（或重复系列在窗口内的各次发生）对应的提醒 (key, 提醒时间, 事件)"""
+        if todo.get('completed') or not todo.get('due_date'):
+            return
+        if todo.get('recurrence'):
+            days = occurrences(todo['recurrence'], todo['due_date'],
+                               (window_start + self.lead).date(), (window_end + self.lead).date())
+            items = [(('occurrence', user_id, todo['id'], day.isoformat()), occurrence_due_date(todo['due_date'], day))
+                     for day in days]
+        else:
+            items = [(('todo', user_id, todo['id']), todo['due_date'])]
+
+        for key, due_date in items:
+            due = parse_due(due_date)
+            if due is None:
+                continue
+            remind_at = due - self.lead
+            if window_start < remind_at <= window_end:
+                yield key, remind_at, {
+                    'user_id': user_id,
+                    'todo_id': key[2] if key[0] == 'todo' else None,
+                    'series_id': key[2] if key[0] == 'occurrence' else None,
+                    'occurrence_date': key[3] if key[0] == 'occurrence' else None,
+                    'title': todo['title'],
+                    'due_date': due_date,
+                }
+
+    def _push(self, key, remind_at, event):
+        """调用方持有锁"""
+        self._scheduled[key] = (remind_at, event)
+        heapq.heappush(self._heap, (remind_at, next(self._counter), key))
+
+    def load_window(self, window_start, window_end):
+        """从所有分片加载 (window_start, window_end] 内到期的提醒"""
+        due_from = format_bound(window_start + self.lead)
+        due_to = format_bound(window_end + self.lead)
+        loaded = []
+        for db_path in all_shard_paths():
+            conn = connect_todo_db(db_path)
+            try:
+                # 没有统计信息时规划器会选择 (completed, completed_at) 索引，这里显式指定部分索引
+                rows = conn.execute('''
+                    SELECT id, user_id, title, due_date, completed, recurrence
+                    FROM todos INDEXED BY idx_todos_pending_due
+                    WHERE completed = 0 AND recurrence IS NULL AND due_date > ? AND due_date <= ?
+                ''', (due_from, due_to)).fetchall()
+                rows += conn.execute('''
+                    SELECT id, user_id, title, due_date, completed, recurrence
+                    FROM todos INDEXED BY idx_todos_pending_series
+                    WHERE completed = 0 AND recurrence IS NOT NULL
+                ''').fetchall()
+                materialized = {
+                    (row['series_id'], row['occurrence_date'])
+                    for row in conn.execute('''
+                        SELECT series_id, occurrence_date FROM todos
+                        WHERE series_id IS NOT NULL AND occurrence_date BETWEEN ? AND ?
+                    ''', (due_from[:10], due_to[:10]))
+                }
+            finally:
+                conn.close()
+            for row in rows:
+                for key, remind_at, event in self._entries(row['user_id'], dict(row), window_start, window_end):
+                    if key[0] == 'occurrence' and key[2:] in materialized:
+                        continue
+                    loaded.append((key, remind_at, event))
+
+        with self._lock:
+            for key, remind_at, event in loaded:
+                self._push(key, remind_at, event)
+            self._loaded_from = self._loaded_from or window_start
+            self._loaded_until = window_end
+        return len(loaded)
+
+    def on_todo_event(self, event, user_id, todo):
+        """TodoModel 写入观察者：调整已加载窗口内的提醒"""
+        with self._lock:
+            if self._loaded_until is None:
+                return
+            # 旧的提醒（包括重复系列的各次发生）全部作废；删除子树时子任务的提醒在触发前确认
+            self._scheduled.pop(('todo', user_id, todo['id']), None)
+            if event == 'deleted' or todo.get('recurrence'):
+                for key in [k for k in self._scheduled
+                            if k[0] == 'occurrence' and k[1] == user_id and k[2] == todo['id']]:
+                    del self._scheduled[key]
+            if event != 'deleted':
+                window_start = max(self._loaded_from, datetime.now())
+                for key, remind_at, reminder in self._entries(user_id, todo, window_start, self._loaded_until):
+                    self._push(key, remind_at, reminder)
+        self._wakeup.set()
+
+    def _still_due(self, key, event):
+        """触发前确认todo仍未完成、截止时间未变（物化过的发生由物化后的todo负责提醒）"""
+        conn = get_todo_db_connection(event['user_id'])
+        try:
+            if key[0] == 'todo':
+                row = conn.execute('''
+                    SELECT 1 FROM todos WHERE id = ? AND user_id = ? AND completed = 0 AND due_date = ?
+                ''', (event['todo_id'], event['user_id'], event['due_date'])).fetchone()
+                return row is not None
+            row = conn.execute('''
+                SELECT 1 FROM todos WHERE id = ? AND user_id = ? AND completed = 0 AND recurrence IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM todos WHERE series_id = ? AND occurrence_date = ?)
+            ''', (event['series_id'], event['user_id'], event['series_id'], event['occurrence_date'])).fetchone()
+            return row is not None
+        finally:
+            conn.close()
+
+    def _pop_due(self, now):
+        """取出所有提醒时间已到的有效堆项"""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                remind_at, _, key = heapq.heappop(self._heap)
+                scheduled = self._scheduled.get(key)
+                if scheduled is None or scheduled[0] != remind_at:
+                    continue
+                del self._scheduled[key]
+                due.append((key, scheduled[1]))
+        return due
+
+    def fire_due(self, now=None):
+        """发送所有到期的提醒，返回发送数量"""
+        fired = 0
+        for key, event in self._pop_due(now or datetime.now()):
+            if not self._still_due(key, event):
+                self.skipped += 1
+                continue
+            try:
+                self.sink(dict(event, fired_at=datetime.now().isoformat(timespec='seconds')))
+                fired += 1
+            except Exception as e:
+                print(f"发送提醒出错: {e}")
+        self.fired += fired
+        return fired
+
+    def run(self):
+        self.load_window(datetime.now(), datetime.now() + self.lookahead)
+        while not self.stop_event.is_set():
+            try:
+                now = datetime.now()
+                # 已加载窗口剩余不到一半时加载下一段
+                if self._loaded_until - now < self.lookahead / 2:
+                    self.load_window(self._loaded_until, now + self.lookahead)
+                self.fire_due(now)
+            except Exception as e:
+                print(f"提醒调度出错: {e}")
+
+            with self._lock:
+                next_at = self._heap[0][0] if self._heap else None
+            sleep = REMINDER_MAX_SLEEP_SECONDS
+            if next_at is not None:
+                sleep = min(sleep, max((next_at - datetime.now()).total_seconds(), 0))
+            self._wakeup.wait(sleep)
+            self._wakeup.clear()
+
+    def stop(self):
+        self.stop_event.set()
+        self._wakeup.set()
+
+_reminder_scheduler = None
+
+def start_reminder_scheduler(sink=None):
+    """启动后台提醒线程（每个进程一个，多进程部署时只在一个进程中启动）"""
+    global _reminder_scheduler
+    if _reminder_scheduler is None:
+        _reminder_scheduler = ReminderScheduler(sink)
+        add_todo_observer(_reminder_scheduler.on_todo_event)
+        _reminder_scheduler.start()
+    return _reminder_scheduler
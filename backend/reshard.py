@@ -0,0 +1,207 @@
+"""在线重新分片
+
+用法（与服务使用相同的环境变量运行）：
+    1. python backend/reshard.py migrate --to 4     逐个用户迁移到新分片，服务无需停止
+    2. 把服务的 TODO_SHARD_COUNT 改为 4 并重启
+    3. python backend/reshard.py finalize            迁移遗留数据并清理不再需要的覆盖记录
+
+每个用户在一个源分片写事务中迁移：复制到目标分片、写入分片目录覆盖记录、删除源数据后提交。
+迁移期间只阻塞同一源分片的写入，读请求不受影响；目录更新后的请求立即路由到目标分片，
+等待源分片写锁的写入在取得写锁后重新确认分片（见 todo_models.begin_user_write），改写到目标分片。
+目标分片的自增id与源分片不同，todo（含归档）和分类的id会重新分配，父任务和重复系列的引用一并改写。
+"""
+import sqlite3
+from shard_router import (
+    jump_hash, shard_path, shard_for_user, all_shard_indexes, shard_directory, TODO_SHARD_COUNT
+)
+from todo_models import init_todo_shard
+from query_cache import invalidate_user
+
+# 按用户存储数据的表
+USER_TABLES = ('todos', 'categories', 'todos_archive', 'todo_daily_stats')
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _insert(conn, table, row, **overrides):
+    values = dict(row)
+    values.update(overrides)
+    columns = ', '.join(values)
+    placeholders = ', '.join('?' for _ in values)
+    conn.execute(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', list(values.values()))
+
+def _next_id(conn, *tables):
+    """目标分片中未被使用过的最小id（考虑自增序列，避免复用已删除的id）"""
+    next_id = 0
+    for table in tables:
+        next_id = max(next_id, conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0])
+        seq = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+        if seq:
+            next_id = max(next_id, seq[0])
+    return next_id + 1
+
+def _reserve_ids(conn, table, last_id):
+    """把自增序列推进到至少 last_id"""
+    if not conn.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (last_id, table)).rowcount:
+        conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, last_id))
+
+def _delete_user(conn, user_id):
+    """删除用户在某个分片中的全部数据"""
+    conn.execute('''
+        DELETE FROM todo_categories WHERE todo_id IN (SELECT id FROM todos WHERE user_id = ?)
+    ''', (user_id,))
+    conn.execute('''
+        DELETE FROM todo_categories_archive WHERE todo_id IN (SELECT id FROM todos_archive WHERE user_id = ?)
+    ''', (user_id,))
+    for table in USER_TABLES:
+        conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+
+def _copy_user(src, dst, user_id):
+    """把用户数据追加复制到目标分片，返回复制的todo数量（含归档）"""
+    category_ids = {}
+    for row in src.execute('SELECT * FROM categories WHERE user_id = ? ORDER BY id', (user_id,)):
+        new_id = dst.execute('''
+            INSERT INTO categories (user_id, name, color, created_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, name) DO UPDATE SET color = excluded.color
+            RETURNING id
+        ''', (user_id, row['name'], row['color'], row['created_at'])).fetchone()[0]
+        category_ids[row['id']] = new_id
+
+    todos = src.execute('SELECT * FROM todos WHERE user_id = ? ORDER BY id', (user_id,)).fetchall()
+    archived = src.execute('SELECT * FROM todos_archive WHERE user_id = ? ORDER BY id', (user_id,)).fetchall()
+
+    # todos 与 todos_archive 共用id空间（归档时保留原id），一起分配新id
+    next_id = _next_id(dst, 'todos', 'todos_archive')
+    todo_ids = {}
+    for row in list(todos) + list(archived):
+        todo_ids[row['id']] = next_id
+        next_id += 1
+
+    for row in todos:
+        _insert(dst, 'todos', row, id=todo_ids[row['id']],
+                parent_id=todo_ids.get(row['parent_id']), series_id=todo_ids.get(row['series_id']))
+    for row in archived:
+        _insert(dst, 'todos_archive', row, id=todo_ids[row['id']], series_id=todo_ids.get(row['series_id']))
+    # 归档行的id也计入todos的自增序列，之后新建的todo不会与其重复
+    if archived:
+        _reserve_ids(dst, 'todos', next_id - 1)
+
+    for table, source in (('todo_categories', 'todos'), ('todo_categories_archive', 'todos_archive')):
+        links = src.execute(f'''
+            SELECT l.todo_id, l.category_id FROM {table} l
+            JOIN {source} t ON t.id = l.todo_id
+            WHERE t.user_id = ?
+        ''', (user_id,)).fetchall()
+        dst.executemany(f'INSERT OR IGNORE INTO {table} (todo_id, category_id) VALUES (?, ?)', [
+            (todo_ids[link['todo_id']], category_ids[link['category_id']])
+            for link in links if link['category_id'] in category_ids
+        ])
+
+    for row in src.execute('SELECT * FROM todo_daily_stats WHERE user_id = ?', (user_id,)):
+        dst.execute('''
+            INSERT INTO todo_daily_stats (user_id, day, created, completed, reopened, deleted)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, day) DO UPDATE SET
+                created = created + excluded.created,
+                completed = completed + excluded.completed,
+                reopened = reopened + excluded.reopened,
+                deleted = deleted + excluded.deleted
+        ''', (user_id, row['day'], row['created'], row['completed'], row['reopened'], row['deleted']))
+
+    return len(todo_ids)
+
+def migrate_user(user_id, source_index, target_index):
+    """把用户在源分片中的数据迁移到目标分片，返回迁移的todo数量
+
+    目标分片已经是该用户的当前分片时（迁移期间写入源分片的遗留数据），追加合并；
+    否则先清除目标分片中上次未完成迁移留下的副本，保证可以重复执行。
+    """
+    source_path = shard_path(source_index)
+    target_path = shard_path(target_index)
+    init_todo_shard(target_path)
+
+    src = _connect(source_path)
+    dst = _connect(target_path)
+    try:
+        # 源分片写锁持续到删除源数据，期间该用户的数据不会再变化
+        src.execute('BEGIN IMMEDIATE')
+        dst.execute('BEGIN IMMEDIATE')
+        if shard_for_user(user_id) != target_index:
+            _delete_user(dst, user_id)
+        copied = _copy_user(src, dst, user_id)
+        dst.commit()
+
+        shard_directory.set(user_id, target_index)
+        _delete_user(src, user_id)
+        src.commit()
+    except Exception:
+        src.rollback()
+        dst.rollback()
+        raise
+    finally:
+        src.close()
+        dst.close()
+
+    invalidate_user(user_id)
+    return copied
+
+def users_in_shard(index):
+    """分片中存有数据的用户"""
+    conn = _connect(shard_path(index))
+    try:
+        union = ' UNION '.join(f'SELECT user_id FROM {table}' for table in USER_TABLES)
+        return [row[0] for row in conn.execute(union)]
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+
+def reshard(shard_count, log=print):
+    """把每个用户迁移到 shard_count 个分片下的目标分片，返回迁移的用户数"""
+    moved = 0
+    for index in sorted(set(all_shard_indexes()) | set(range(shard_count))):
+        for user_id in users_in_shard(index):
+            target = jump_hash(user_id, shard_count)
+            if target == index:
+                continue
+            count = migrate_user(user_id, index, target)
+            moved += 1
+            log(f"用户 {user_id}: 分片 {index} -> {target}，{count} 条todo")
+    return moved
+
+def finalize(shard_count=TODO_SHARD_COUNT, log=print):
+    """服务切换到新分片数后执行：迁移遗留数据，删除与哈希结果一致的覆盖记录"""
+    moved = reshard(shard_count, log)
+    redundant = [
+        user_id for user_id, index in shard_directory.overrides().items()
+        if index == jump_hash(user_id, shard_count)
+    ]
+    removed = shard_directory.remove(redundant)
+    log(f"迁移遗留数据 {moved} 个用户，清理覆盖记录 {removed} 条")
+
+    unused = [
+        shard_path(index) for index in all_shard_indexes(shard_count)
+        if index >= shard_count and not users_in_shard(index)
+    ]
+    for path in unused:
+        log(f"分片已清空，可以删除: {path}")
+    return moved, removed
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='todo数据在线重新分片')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='把用户迁移到新的分片数下的目标分片')
+    migrate_parser.add_argument('--to', type=int, required=True, help='新的分片数')
+    finalize_parser = subparsers.add_parser('finalize', help='切换分片数后清理遗留数据和覆盖记录')
+    finalize_parser.add_argument('--count', type=int, default=TODO_SHARD_COUNT, help='当前分片数（默认 TODO_SHARD_COUNT）')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        moved = reshard(args.to)
+        print(f"共迁移 {moved} 个用户，请把 TODO_SHARD_COUNT 改为 {args.to} 并重启服务后执行 finalize")
+    else:
+        finalize(args.count)
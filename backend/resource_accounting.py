@@ -0,0 +1,353 @@
+"""按用户统计资源使用
+
+每个请求在上下文中累计SQL耗时和读写行数（通过 connect() 打开的连接和 SQLAlchemy 引擎事件采集），
+请求结束时连同响应字节数计入请求所属的用户；没有登录用户的请求不统计。
+统计先在内存中按用户汇总，后台线程每 USAGE_FLUSH_SECONDS 秒写入 usage.db 的 user_usage 表（每用户每天一行）。
+
+设置 USAGE_BUDGET_SQL_MS 或 USAGE_BUDGET_ROWS 后，用户在 USAGE_BUDGET_WINDOW_SECONDS 秒的窗口内
+超出任一配额时，需要登录的请求返回 429，直到窗口结束。
+"""
+import atexit
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from cold_start import ensure_once, stamp_schema, schema_is_current
+from shard_router import DATABASE_DIR
+import tracing
+
+USAGE_DATABASE_PATH = os.environ.get('USAGE_DATABASE_PATH', os.path.join(DATABASE_DIR, 'usage.db'))
+USAGE_SCHEMA_VERSION = 1
+USAGE_FLUSH_SECONDS = int(os.environ.get('USAGE_FLUSH_SECONDS', 60))
+# 每个窗口内每个用户的配额，0 表示不限制
+USAGE_BUDGET_SQL_MS = float(os.environ.get('USAGE_BUDGET_SQL_MS', 0))
+USAGE_BUDGET_ROWS = int(os.environ.get('USAGE_BUDGET_ROWS', 0))
+USAGE_BUDGET_WINDOW_SECONDS = int(os.environ.get('USAGE_BUDGET_WINDOW_SECONDS', 60))
+# 可用于排行的指标
+USAGE_METRICS = ('requests', 'sql_ms', 'rows', 'bytes_out')
+MAX_USAGE_DAYS = 90
+
+_current_usage = ContextVar('current_usage', default=None)
+
+class RequestUsage:
+    """一个请求累计的资源使用"""
+
+    __slots__ = ('user_id', 'sql_ms', 'rows', 'bytes_out')
+
+    def __init__(self):
+        self.user_id = None
+        self.sql_ms = 0.0
+        self.rows = 0
+        self.bytes_out = 0
+
+    def add(self, seconds, rows):
+        self.sql_ms += seconds * 1000
+        self.rows += rows
+
+class AccountedCursor(tracing.TracedCursor):
+    """把语句执行和读取结果的耗时、行数计入当前请求的游标"""
+
+    def execute(self, sql, parameters=()):
+        usage = _current_usage.get()
+        if usage is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            # 查询语句的 rowcount 为 -1，读取的行数在 fetch 时计入
+            usage.add(time.perf_counter() - start, max(self.rowcount, 0))
+
+    def executemany(self, sql, seq_of_parameters):
+        usage = _current_usage.get()
+        if usage is None:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            usage.add(time.perf_counter() - start, max(self.rowcount, 0))
+
+    def fetchone(self):
+        usage = _current_usage.get()
+        if usage is None:
+            return super().fetchone()
+        start = time.perf_counter()
+        row = super().fetchone()
+        usage.add(time.perf_counter() - start, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        usage = _current_usage.get()
+        if usage is None:
+            return super().fetchmany(size or self.arraysize)
+        start = time.perf_counter()
+        rows = super().fetchmany(size or self.arraysize)
+        usage.add(time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        usage = _current_usage.get()
+        if usage is None:
+            return super().fetchall()
+        start = time.perf_counter()
+        rows = super().fetchall()
+        usage.add(time.perf_counter() - start, len(rows))
+        return rows
+
+    def __next__(self):
+        usage = _current_usage.get()
+        if usage is None:
+            return super().__next__()
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            usage.add(time.perf_counter() - start, 0)
+            raise
+        usage.add(time.perf_counter() - start, 1)
+        return row
+
+class AccountedConnection(tracing.TracedConnection):
+    def cursor(self, factory=AccountedCursor):
+        return super().cursor(factory)
+
+def connect(db_path, **kwargs):
+    """打开带追踪和资源统计的sqlite连接"""
+    return tracing.connect(db_path, factory=AccountedConnection, **kwargs)
+
+def instrument_sqlalchemy(engine):
+    """把SQLAlchemy引擎执行的语句计入当前请求（只能统计写入的行数）"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current_usage.get() is not None:
+            conn.info.setdefault('usage_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        usage = _current_usage.get()
+        started = conn.info.get('usage_started')
+        if usage is not None and started:
+            usage.add(time.perf_counter() - started.pop(), max(cursor.rowcount, 0))
+
+def start_request():
+    """开始统计一个请求，返回传给 end_request 的状态"""
+    usage = RequestUsage()
+    return usage, _current_usage.set(usage)
+
+def attribute(user_id):
+    """把当前请求计入用户（认证通过后调用）"""
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.user_id = user_id
+
+def end_request(state):
+    usage, token = state
+    try:
+        _current_usage.reset(token)
+    except ValueError:
+        # 在其他上下文中结束，直接清除
+        _current_usage.set(None)
+    if usage.user_id is not None:
+        usage_accounting.record(usage.user_id, usage.sql_ms, usage.rows, usage.bytes_out)
+
+def init_usage_db(db_path=USAGE_DATABASE_PATH, force=False):
+    """创建用量统计表（schema版本已是最新时跳过）"""
+    if not force and schema_is_current(db_path, USAGE_SCHEMA_VERSION):
+        return
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_usage (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            sql_ms REAL NOT NULL DEFAULT 0,
+            rows INTEGER NOT NULL DEFAULT 0,
+            bytes_out INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    stamp_schema(conn, USAGE_SCHEMA_VERSION)
+    conn.commit()
+    conn.close()
+
+class UsageAccounting:
+    """内存中的按用户用量汇总和配额窗口（线程安全）"""
+
+    def __init__(self, db_path=USAGE_DATABASE_PATH, budget_sql_ms=USAGE_BUDGET_SQL_MS,
+                 budget_rows=USAGE_BUDGET_ROWS, window=USAGE_BUDGET_WINDOW_SECONDS):
+        self.db_path = db_path
+        self.budget_sql_ms = budget_sql_ms
+        self.budget_rows = budget_rows
+        self.window = window
+        self._lock = threading.Lock()
+        # user_id -> [requests, sql_ms, rows, bytes_out]，尚未写入数据库
+        self._pending = {}
+        # user_id -> [窗口序号, sql_ms, rows]，只在设置了配额时维护
+        self._windows = {}
+        self.throttled = 0
+
+    @property
+    def budgets_enabled(self):
+        return bool(self.budget_sql_ms or self.budget_rows)
+
+    def record(self, user_id, sql_ms, rows, bytes_out):
+        with self._lock:
+            totals = self._pending.get(user_id)
+            if totals is None:
+                totals = self._pending[user_id] = [0, 0.0, 0, 0]
+            totals[0] += 1
+            totals[1] += sql_ms
+            totals[2] += rows
+            totals[3] += bytes_out
+            if self.budgets_enabled:
+                index = int(time.time() // self.window)
+                window = self._windows.get(user_id)
+                if window is None or window[0] != index:
+                    window = self._windows[user_id] = [index, 0.0, 0]
+                window[1] += sql_ms
+                window[2] += rows
+
+    def retry_after(self, user_id):
+        """用户在当前窗口内超出配额时返回距窗口结束的秒数，否则返回 None"""
+        if not self.budgets_enabled:
+            return None
+        now = time.time()
+        index = int(now // self.window)
+        with self._lock:
+            window = self._windows.get(user_id)
+            if window is None or window[0] != index:
+                return None
+            if (self.budget_sql_ms and window[1] >= self.budget_sql_ms) or \
+                    (self.budget_rows and window[2] >= self.budget_rows):
+                self.throttled += 1
+                return max(1, math.ceil((index + 1) * self.window - now))
+        return None
+
+    def flush(self):
+        """把内存中的用量累加到 user_usage 表，返回写入的用户数"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # 顺便清理已结束的配额窗口
+            index = int(time.time() // self.window)
+            self._windows = {user_id: w for user_id, w in self._windows.items() if w[0] == index}
+        if not pending:
+            return 0
+
+        ensure_once(self.db_path, lambda: init_usage_db(self.db_path))
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                conn.executemany('''
+                    INSERT INTO user_usage (day, user_id, requests, sql_ms, rows, bytes_out)
+                    VALUES (date('now'), ?, ?, ?, ?, ?)
+                    ON CONFLICT (day, user_id) DO UPDATE SET
+                        requests = requests + excluded.requests,
+                        sql_ms = sql_ms + excluded.sql_ms,
+                        rows = rows + excluded.rows,
+                        bytes_out = bytes_out + excluded.bytes_out
+                ''', [(user_id, *totals) for user_id, totals in pending.items()])
+        except sqlite3.Error:
+            # 写入失败时放回内存，下次再写
+            with self._lock:
+                for user_id, totals in pending.items():
+                    current = self._pending.setdefault(user_id, [0, 0.0, 0, 0])
+                    for i, value in enumerate(totals):
+                        current[i] += value
+            raise
+        finally:
+            conn.close()
+        return len(pending)
+
+    def top(self, metric='sql_ms', limit=10, days=1):
+        """最近 days 天（含今天）按 metric 排名前 limit 的用户"""
+        if metric not in USAGE_METRICS:
+            raise ValueError(f'不支持的指标: {metric}')
+        self.flush()
+        if not os.path.exists(self.db_path):
+            return []
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute(f'''
+                SELECT user_id, SUM(requests) AS requests, ROUND(SUM(sql_ms), 3) AS sql_ms,
+                       SUM(rows) AS rows, SUM(bytes_out) AS bytes_out
+                FROM user_usage
+                WHERE day >= date('now', ?)
+                GROUP BY user_id
+                ORDER BY {metric} DESC
+                LIMIT ?
+            ''', (f'-{days - 1} days', limit)).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+usage_accounting = UsageAccounting()
+
+class UsageFlusher(threading.Thread):
+    """后台线程，定期把用量写入数据库"""
+
+    def __init__(self, interval=USAGE_FLUSH_SECONDS):
+        super().__init__(name='usage-flusher', daemon=True)
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                usage_accounting.flush()
+            except Exception as e:
+                print(f"写入用量统计出错: {e}")
+
+    def stop(self):
+        self.stop_event.set()
+
+_usage_flusher = None
+
+def start_usage_flusher():
+    """启动后台用量写入线程（每个进程一个），进程退出时写入剩余用量"""
+    global _usage_flusher
+    if _usage_flusher is None:
+        _usage_flusher = UsageFlusher()
+        _usage_flusher.start()
+        atexit.register(usage_accounting.flush)
+    return _usage_flusher
+
+def init_flask(app):
+    """为Flask应用注册请求用量统计"""
+    from flask import g
+
+    @app.before_request
+    def start_request_usage():
+        g.usage = start_request()
+
+    @app.after_request
+    def record_response_size(response):
+        state = g.get('usage')
+        if state is not None:
+            state[0].bytes_out = response.content_length or 0
+        return response
+
+    @app.teardown_request
+    def end_request_usage(error=None):
+        state = g.pop('usage', None)
+        if state is not None:
+            end_request(state)
+
+def init_fastapi(app):
+    """为FastAPI应用注册请求用量统计中间件"""
+
+    @app.middleware('http')
+    async def account_requests(request, call_next):
+        state = start_request()
+        try:
+            response = await call_next(request)
+            state[0].bytes_out = int(response.headers.get('content-length', 0))
+            return response
+        finally:
+            end_request(state)
@@ -0,0 +1,156 @@
+"""todo数据分片路由
+
+每个用户的全部todo数据（todos、分类、归档、历史汇总）都位于同一个分片文件中，
+所有查询都按 user_id 限定，因此不存在跨分片查询，写锁也只在同一分片的用户之间竞争。
+
+用户到分片的映射：
+1. 先查分片目录（shard_directory.db）中的覆盖记录，重新分片时迁移过的用户记录在这里
+2. 没有覆盖记录时用 jump consistent hash 计算，分片数从 N 增加到 M 时只有约 (M-N)/M 的用户需要移动
+
+第0片固定是原来的 todo.db，单分片部署与之前完全相同。
+"""
+import os
+import sqlite3
+import threading
+
+# 数据库目录
+DATABASE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database')
+TODO_DATABASE_PATH = os.path.join(DATABASE_DIR, 'todo.db')
+
+# 分片数量，修改前需要先用 reshard.py 迁移数据
+TODO_SHARD_COUNT = int(os.environ.get('TODO_SHARD_COUNT', 1))
+# 分片目录（覆盖记录）数据库
+SHARD_DIRECTORY_PATH = os.environ.get('TODO_SHARD_DIRECTORY', os.path.join(DATABASE_DIR, 'shard_directory.db'))
+
+def jump_hash(key, buckets):
+    """Jump consistent hash（Lamping & Veach），把整数key稳定地映射到 [0, buckets)"""
+    if buckets < 1:
+        raise ValueError('分片数必须大于0')
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+def shard_path(index):
+    """分片编号对应的数据库文件，第0片沿用 todo.db"""
+    if index == 0:
+        return TODO_DATABASE_PATH
+    return os.path.join(DATABASE_DIR, f'todo_shard_{index}.db')
+
+class ShardDirectory:
+    """用户到分片的覆盖记录
+
+    覆盖记录缓存在进程内存中。目录库使用回滚日志模式，每次提交都会递增文件头中的
+    修改计数器，查询时只读取这4个字节判断是否需要重新加载，其他进程的迁移结果在下一次查询时生效。
+    重新加载后，分片发生变化的用户会通知给 add_listener 注册的回调（如清除这些用户的查询缓存）。
+    """
+
+    def __init__(self, path=SHARD_DIRECTORY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._version = None
+        self._overrides = {}
+        self._listeners = []
+
+    def add_listener(self, fn):
+        """注册回调 fn(user_ids)，重新加载后以分片发生变化的用户调用"""
+        self._listeners.append(fn)
+
+    def _file_version(self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(24)
+                return f.read(4)
+        except FileNotFoundError:
+            return None
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_shards (
+                user_id INTEGER PRIMARY KEY,
+                shard INTEGER NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        return conn
+
+    def overrides(self):
+        """返回 {user_id: 分片编号}，文件变化时重新加载"""
+        version = self._file_version()
+        changed = ()
+        with self._lock:
+            if version != self._version:
+                previous = self._overrides
+                if version is None:
+                    self._overrides = {}
+                else:
+                    conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, timeout=10)
+                    try:
+                        self._overrides = dict(conn.execute('SELECT user_id, shard FROM user_shards'))
+                    except sqlite3.OperationalError:
+                        self._overrides = {}
+                    finally:
+                        conn.close()
+                self._version = version
+                changed = [
+                    user_id for user_id in previous.keys() | self._overrides.keys()
+                    if previous.get(user_id) != self._overrides.get(user_id)
+                ]
+            overrides = self._overrides
+        if changed:
+            for fn in self._listeners:
+                fn(changed)
+        return overrides
+
+    def get(self, user_id):
+        return self.overrides().get(user_id)
+
+    def set(self, user_id, shard):
+        conn = self._connect()
+        try:
+            conn.execute('''
+                INSERT INTO user_shards (user_id, shard) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET shard = excluded.shard, updated_at = CURRENT_TIMESTAMP
+            ''', (user_id, shard))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove(self, user_ids):
+        if not user_ids or not os.path.exists(self.path):
+            return 0
+        conn = self._connect()
+        try:
+            cursor = conn.executemany('DELETE FROM user_shards WHERE user_id = ?', [(u,) for u in user_ids])
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+shard_directory = ShardDirectory()
+
+def shard_for_user(user_id, shard_count=None):
+    """用户所在的分片编号"""
+    override = shard_directory.get(user_id)
+    if override is not None:
+        return override
+    return jump_hash(user_id, shard_count or TODO_SHARD_COUNT)
+
+def shard_path_for_user(user_id):
+    """用户所在分片的数据库文件"""
+    return shard_path(shard_for_user(user_id))
+
+def all_shard_indexes(shard_count=None):
+    """当前配置的分片以及覆盖记录指向的分片（重新分片期间目标分片可能超出当前分片数）"""
+    indexes = set(range(shard_count or TODO_SHARD_COUNT))
+    indexes.update(shard_directory.overrides().values())
+    return sorted(indexes)
+
+def all_shard_paths(shard_count=None):
+    """所有需要初始化、归档和维护的分片文件"""
+    return [shard_path(index) for index in all_shard_indexes(shard_count)]
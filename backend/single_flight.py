@@ -0,0 +1,86 @@
+import os
+import threading
+
+# 跟随请求等待进行中计算的最长时间（秒），超时后自行计算
+SINGLE_FLIGHT_TIMEOUT_SECONDS = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT_SECONDS', 5))
+
+class _Call:
+    """一次进行中的计算"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.failed = False
+        self.waiters = 0
+
+class SingleFlight:
+    """合并并发的相同请求：同一个key同时只执行一次计算，其余调用等待并共享结果（线程安全）
+
+    只合并时间上重叠的调用，计算完成后立即移除，不保留结果；需要缓存时使用 query_cache。
+    """
+
+    def __init__(self, timeout=SINGLE_FLIGHT_TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+        self.timeouts = 0
+        self.fallbacks = 0
+
+    def do(self, key, fn, timeout=None):
+        """执行或加入 key 对应的计算，返回 (结果, 是否共享了其他调用的结果)
+
+        执行者出错时异常只抛给执行者，等待者各自重新计算
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.followers += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException:
+                call.failed = True
+                raise
+            finally:
+                # 先移除再唤醒，之后到达的调用会开始新的计算
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+            return call.result, False
+
+        if not call.event.wait(self.timeout if timeout is None else timeout):
+            with self._lock:
+                self.timeouts += 1
+            return fn(), False
+        if call.failed:
+            with self._lock:
+                self.fallbacks += 1
+            return fn(), False
+        return call.result, True
+
+    def stats(self):
+        with self._lock:
+            calls = self.leaders + self.followers
+            # 超时或执行者出错的等待者自行计算，不计入合并数
+            coalesced = self.followers - self.timeouts - self.fallbacks
+            return {
+                'calls': calls,
+                'executions': calls - coalesced,
+                'coalesced': coalesced,
+                'coalescing_ratio': round(coalesced / calls, 4) if calls else 0,
+                'timeouts': self.timeouts,
+                'fallbacks': self.fallbacks,
+                'in_flight': len(self._calls),
+                'timeout_seconds': self.timeout,
+            }
+
+single_flight = SingleFlight()
@@ -0,0 +1,59 @@
+"""并发切换完成状态的压力测试：toggle_todo 为单条 UPDATE ... RETURNING，不应丢失更新"""
+import sqlite3
+import threading
+
+import pytest
+
+import shard_router
+from todo_models import TodoModel, init_todo_shard
+
+THREADS = 8
+TOGGLES_PER_THREAD = 50
+
+@pytest.fixture
+def todo_db(tmp_path, monkeypatch):
+    """把分片目录和todo库指向临时目录"""
+    monkeypatch.setattr(shard_router, 'DATABASE_DIR', str(tmp_path))
+    monkeypatch.setattr(shard_router, 'TODO_DATABASE_PATH', str(tmp_path / 'todo.db'))
+    monkeypatch.setattr(shard_router, 'TODO_SHARD_COUNT', 1)
+    monkeypatch.setattr(shard_router.shard_directory, 'path', str(tmp_path / 'shard_directory.db'))
+    init_todo_shard(shard_router.TODO_DATABASE_PATH, force=True)
+    return shard_router.TODO_DATABASE_PATH
+
+def test_concurrent_toggles_lose_no_updates(todo_db):
+    user_id = 1
+    todo = TodoModel.create_todo(user_id, '并发切换')
+    errors = []
+    barrier = threading.Barrier(THREADS)
+
+    def worker():
+        try:
+            barrier.wait()
+            for _ in range(TOGGLES_PER_THREAD):
+                assert TodoModel.toggle_todo(todo['id'], user_id) is not None
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+    total = THREADS * TOGGLES_PER_THREAD
+    conn = sqlite3.connect(todo_db)
+    try:
+        completed = conn.execute('SELECT completed FROM todos WHERE id = ?', (todo['id'],)).fetchone()[0]
+        counts = conn.execute('''
+            SELECT SUM(completed), SUM(reopened) FROM todo_daily_stats WHERE user_id = ?
+        ''', (user_id,)).fetchone()
+    finally:
+        conn.close()
+
+    # 偶数次切换后回到未完成；每次切换恰好记录一次完成或重新打开
+    assert completed == total % 2
+    assert counts[0] + counts[1] == total
+    assert counts[0] == (total + 1) // 2
+    assert counts[1] == total // 2
@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from todo_models import get_todo_db_connection, connect_todo_db
+from shard_router import all_shard_paths
+from query_cache import cached_query, invalidate_users, invalidation_log
+
+# 归档配置
+ARCHIVE_AFTER_DAYS = int(os.environ.get('TODO_ARCHIVE_AFTER_DAYS', 30))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('TODO_ARCHIVE_BATCH_SIZE', 500))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('TODO_ARCHIVE_INTERVAL_SECONDS', 3600))
+# 批次之间的间隔，让出写锁给在线请求
+ARCHIVE_BATCH_PAUSE_SECONDS = 0.05
+
+# 在todos与todos_archive之间搬运的列
+ARCHIVE_COLUMNS = (
+    'id', 'user_id', 'title', 'description', 'completed', 'priority',
+    'due_date', 'created_at', 'updated_at', 'completed_at', 'series_id', 'occurrence_date'
+)
+
+class ArchiveModel:
+    """归档数据模型"""
+
+    @staticmethod
+    def archive_batch(db_path, older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+        """在一个分片中归档一批完成超过N天的todo，返回 (归档数量, 涉及的用户id集合)
+
+        只归档没有子任务的todo，父任务在子任务归档后的下一轮才会被归档
+        """
+        conn = connect_todo_db(db_path)
+        columns = ', '.join(ARCHIVE_COLUMNS)
+
+        try:
+            # 立即获取写锁，保证选出的批次在搬运期间不被修改
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('''
+                SELECT id, user_id FROM todos
+                WHERE completed = 1
+                  AND COALESCE(completed_at, updated_at) < datetime('now', ?)
+                  AND NOT EXISTS (SELECT 1 FROM todos c WHERE c.parent_id = todos.id)
+                LIMIT ?
+            ''', (f'-{int(older_than_days)} days', batch_size)).fetchall()
+
+            if not rows:
+                conn.rollback()
+                return 0, set()
+
+            todo_ids = [row['id'] for row in rows]
+            placeholders = ', '.join('?' for _ in todo_ids)
+
+            conn.execute(f'''
+                INSERT OR REPLACE INTO todos_archive ({columns})
+                SELECT {columns} FROM todos WHERE id IN ({placeholders})
+            ''', todo_ids)
+            conn.execute(f'''
+                INSERT OR IGNORE INTO todo_categories_archive (todo_id, category_id)
+                SELECT todo_id, category_id FROM todo_categories WHERE todo_id IN ({placeholders})
+            ''', todo_ids)
+            conn.execute(f'DELETE FROM todo_categories WHERE todo_id IN ({placeholders})', todo_ids)
+            conn.execute(f'DELETE FROM todos WHERE id IN ({placeholders})', todo_ids)
+            conn.commit()
+
+            user_ids = {row['user_id'] for row in rows}
+            invalidate_users(user_ids)
+            return len(todo_ids), user_ids
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def archive_completed(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, stop_event=None):
+        """逐个分片分批归档所有符合条件的todo，返回归档总数"""
+        total = 0
+        for db_path in all_shard_paths():
+            while not (stop_event and stop_event.is_set()):
+                archived, _ = ArchiveModel.archive_batch(db_path, older_than_days, batch_size)
+                total += archived
+                if archived < batch_size:
+                    break
+                time.sleep(ARCHIVE_BATCH_PAUSE_SECONDS)
+        return total
+
+    @staticmethod
+    def get_archived_todos(user_id, page=1, page_size=20):
+        """分页获取用户已归档的todos"""
+        conn = get_todo_db_connection(user_id)
+
+        total = conn.execute('''
+            SELECT COUNT(*) FROM todos_archive WHERE user_id = ?
+        ''', (user_id,)).fetchone()[0]
+
+        todos = conn.execute('''
+            SELECT a.*, GROUP_CONCAT(c.name) as categories
+            FROM todos_archive a
+            LEFT JOIN todo_categories_archive tca ON a.id = tca.todo_id
+            LEFT JOIN categories c ON tca.category_id = c.id
+            WHERE a.user_id = ?
+            GROUP BY a.id
+            ORDER BY a.completed_at DESC
+            LIMIT ? OFFSET ?
+        ''', (user_id, page_size, (page - 1) * page_size)).fetchall()
+
+        conn.close()
+        return {
+            'items': [dict(todo) for todo in todos],
+            'total': total,
+            'page': page,
+            'page_size': page_size
+        }
+
+    @staticmethod
+    @cached_query('archived_count')
+    def count_archived(user_id):
+        """获取用户已归档的todo数量"""
+        conn = get_todo_db_connection(user_id)
+        count = conn.execute('''
+            SELECT COUNT(*) FROM todos_archive WHERE user_id = ?
+        ''', (user_id,)).fetchone()[0]
+        conn.close()
+        return count
+
+class ArchiveWorker(threading.Thread):
+    """后台归档线程，定期分批归档已完成的todo"""
+
+    def __init__(self, interval=ARCHIVE_INTERVAL_SECONDS, older_than_days=ARCHIVE_AFTER_DAYS,
+                 batch_size=ARCHIVE_BATCH_SIZE):
+        super().__init__(name='todo-archive-worker', daemon=True)
+        self.interval = interval
+        self.older_than_days = older_than_days
+        self.batch_size = batch_size
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                archived = ArchiveModel.archive_completed(
+                    self.older_than_days, self.batch_size, self.stop_event
+                )
+                if archived:
+                    print(f"已归档 {archived} 条完成超过 {self.older_than_days} 天的todo")
+            except Exception as e:
+                print(f"归档任务出错: {e}")
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+
+_archive_worker = None
+
+def start_archive_worker():
+    """启动后台归档线程（每个进程一个）"""
+    global _archive_worker
+    if _archive_worker is None:
+        _archive_worker = ArchiveWorker()
+        _archive_worker.start()
+    return _archive_worker
+
+if __name__ == '__main__':
+    import argparse
+    from todo_models import init_todo_db
+
+    parser = argparse.ArgumentParser(description='归档已完成的todo')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help='完成超过N天的todo将被归档')
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='每个事务归档的最大条数')
+    args = parser.parse_args()
+
+    init_todo_db()
+    # 命令行进程的缓存失效需要写入失效记录，服务进程才能清除这些用户的缓存
+    invalidation_log.publishing = True
+    archived = ArchiveModel.archive_completed(args.days, args.batch_size)
+    print(f"共归档 {archived} 条todo")
@@ -0,0 +1,129 @@
+from datetime import date, timedelta
+from todo_models import get_todo_db_connection, connect_todo_db
+from shard_router import all_shard_paths
+
+GRANULARITIES = ('day', 'week', 'month')
+# 历史查询允许的最大日期范围
+MAX_HISTORY_DAYS = 5 * 366
+
+# 各粒度的分桶表达式（周从周一开始）
+_BUCKETS = {
+    'day': 'day',
+    'week': "date(day, '-6 days', 'weekday 1')",
+    'month': "strftime('%Y-%m-01', day)",
+}
+
+def _bucket_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+def _next_bucket(day, granularity):
+    if granularity == 'week':
+        return day + timedelta(weeks=1)
+    if granularity == 'month':
+        return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return day + timedelta(days=1)
+
+class HistoryModel:
+    """完成历史数据模型"""
+
+    @staticmethod
+    def get_history(user_id, start, end, granularity='day'):
+        """按天/周/月汇总日期范围内的事件，只读取汇总表，没有事件的区间补0"""
+        conn = get_todo_db_connection(user_id)
+        bucket = _BUCKETS[granularity]
+
+        rows = conn.execute(f'''
+            SELECT {bucket} as bucket,
+                   SUM(created) as created,
+                   SUM(completed) as completed,
+                   SUM(reopened) as reopened,
+                   SUM(deleted) as deleted
+            FROM todo_daily_stats
+            WHERE user_id = ? AND day BETWEEN ? AND ?
+            GROUP BY bucket
+        ''', (user_id, start.isoformat(), end.isoformat())).fetchall()
+        conn.close()
+
+        by_bucket = {row['bucket']: row for row in rows}
+        series = []
+        current = _bucket_start(start, granularity)
+        while current <= end:
+            row = by_bucket.get(current.isoformat())
+            series.append({
+                'period': current.isoformat(),
+                'created': row['created'] if row else 0,
+                'completed': row['completed'] if row else 0,
+                'reopened': row['reopened'] if row else 0,
+                'deleted': row['deleted'] if row else 0,
+            })
+            current = _next_bucket(current, granularity)
+        return series
+
+    @staticmethod
+    def backfill(user_id=None):
+        """根据现有todo（含已归档）补齐汇总表上线前的每日创建数和完成数，未指定用户时回填所有分片
+
+        现有数据只能重建部分历史：已删除的todo不再计入创建数，完成后又重新打开的不再计入完成数，
+        删除和重新打开事件也无法恢复；与写入路径一致，重复任务物化的发生不计入创建数。
+        因此只回填每个用户最早一条汇总记录之前的日期，写入路径已记录的汇总不会被覆盖或调低；
+        重复执行不会重复计数。
+        """
+        if user_id is not None:
+            return HistoryModel._backfill_connection(get_todo_db_connection(user_id), user_id)
+        return sum(HistoryModel._backfill_connection(connect_todo_db(db_path)) for db_path in all_shard_paths())
+
+    @staticmethod
+    def _backfill_connection(conn, user_id=None):
+        user_filter = 'AND events.user_id = ?' if user_id is not None else ''
+        params = [user_id] if user_id is not None else []
+
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(f'''
+                INSERT INTO todo_daily_stats (user_id, day, created, completed)
+                SELECT user_id, day, SUM(created), SUM(completed)
+                FROM (
+                    SELECT user_id, date(created_at) as day, 1 as created, 0 as completed FROM todos WHERE series_id IS NULL
+                    UNION ALL
+                    SELECT user_id, date(COALESCE(completed_at, updated_at)), 0, 1 FROM todos WHERE completed = 1
+                    UNION ALL
+                    SELECT user_id, date(created_at), 1, 0 FROM todos_archive WHERE series_id IS NULL
+                    UNION ALL
+                    SELECT user_id, date(COALESCE(completed_at, updated_at)), 0, 1 FROM todos_archive
+                ) AS events
+                WHERE events.day < COALESCE(
+                    (SELECT MIN(s.day) FROM todo_daily_stats s WHERE s.user_id = events.user_id), '9999-12-31'
+                ) {user_filter}
+                GROUP BY user_id, day
+                ON CONFLICT (user_id, day) DO NOTHING
+            ''', params)
+            rows = conn.execute('SELECT changes()').fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return rows
+
+def default_history_window(days=90):
+    """默认查询最近90天"""
+    end = date.today()
+    return end - timedelta(days=days - 1), end
+
+if __name__ == '__main__':
+    import argparse
+    from todo_models import init_todo_db
+
+    parser = argparse.ArgumentParser(description='完成历史汇总')
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--user-id', type=int, help='只回填指定用户')
+    args = parser.parse_args()
+
+    init_todo_db()
+    rows = HistoryModel.backfill(args.user_id)
+    print(f"已回填 {rows} 条每日汇总")
@@ -1,18 +1,72 @@
 import sqlite3
 import os
+import json
+import threading
+from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache
+from fractional_index import key_between, key_before, evenly_spaced_keys
+from recurrence import parse_rule, occurrences, is_occurrence, occurrence_due_date
+from cold_start import COLD_START_MODE, schema_is_current, stamp_schema, ensure_once
+from query_cache import cached_query, invalidate_user
+from shard_router import shard_path_for_user, all_shard_paths
+import tracing
+import resource_accounting
 
-# 数据库路径
-TODO_DATABASE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database', 'todo.db')
+# schema版本，每次修改下面的DDL时递增
+TODO_SCHEMA_VERSION = 9
 
-def init_todo_db():
-    """初始化todo数据库"""
+# 可以直接修改的字段
+UPDATABLE_FIELDS = ('title', 'description', 'completed', 'priority', 'due_date')
+# 可以原子取反的字段
+TOGGLEABLE_FIELDS = ('completed',)
+# 可以按步长原子调整的字段及其SET表达式（参数为步长）
+INCREMENTABLE_FIELDS = {
+    'priority': '''priority = CASE MIN(MAX(
+        CASE priority WHEN 'low' THEN 0 WHEN 'medium' THEN 1 ELSE 2 END + ?, 0), 2)
+        WHEN 0 THEN 'low' WHEN 1 THEN 'medium' ELSE 'high' END''',
+}
+
+# 以某个todo为根的子树（含根节点），参数为 (todo_id, user_id)
+SUBTREE_CTE = '''
+    WITH RECURSIVE subtree(id, depth) AS (
+        SELECT id, 0 FROM todos WHERE id = ? AND user_id = ?
+        UNION ALL
+        SELECT t.id, s.depth + 1 FROM todos t JOIN subtree s ON t.parent_id = s.id
+    )
+'''
+
+# 列表接口可以投影的字段（category_ids 为分类id数组）
+TODO_LIST_FIELDS = (
+    'id', 'title', 'description', 'completed', 'priority', 'due_date', 'created_at', 'updated_at',
+    'completed_at', 'position', 'parent_id', 'recurrence', 'series_id', 'occurrence_date', 'category_ids'
+)
+# 展开重复任务需要的字段，投影中没有时额外读取
+RECURRENCE_FIELDS = ('id', 'completed', 'due_date', 'recurrence', 'series_id', 'occurrence_date')
+
+# 排序键超过该长度时在后台重新平衡该用户的排序键
+POSITION_REBALANCE_LENGTH = 12
+
+def init_todo_db(force=False):
+    """初始化所有分片的todo数据库"""
+    for db_path in all_shard_paths():
+        init_todo_shard(db_path, force)
+
+def init_todo_shard(db_path, force=False):
+    """初始化一个分片（schema版本已是最新时跳过DDL）"""
     # 确保数据库目录存在
-    os.makedirs(os.path.dirname(TODO_DATABASE_PATH), exist_ok=True)
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    
+    if not force and schema_is_current(db_path, TODO_SCHEMA_VERSION):
+        return
     
-    conn = sqlite3.connect(TODO_DATABASE_PATH)
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
+    # 新建数据库时启用增量清理；WAL模式下读写互不阻塞，检查点由维护任务控制
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    cursor.execute('PRAGMA journal_mode = WAL')
+    
     # 创建todos表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS todos (
@@ -25,9 +79,22 @@ def init_todo_db():
             due_date DATETIME,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
+            completed_at DATETIME,
+            position TEXT,
+            parent_id INTEGER,
+            recurrence TEXT,
+            series_id INTEGER,
+            occurrence_date TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (parent_id) REFERENCES todos (id)
         )
     ''')
+    _add_column_if_missing(cursor, 'todos', 'completed_at', 'DATETIME')
+    _add_column_if_missing(cursor, 'todos', 'position', 'TEXT')
+    _add_column_if_missing(cursor, 'todos', 'parent_id', 'INTEGER REFERENCES todos (id)')
+    _add_column_if_missing(cursor, 'todos', 'recurrence', 'TEXT')
+    _add_column_if_missing(cursor, 'todos', 'series_id', 'INTEGER')
+    _add_column_if_missing(cursor, 'todos', 'occurrence_date', 'TEXT')
     
     # 创建分类表
     cursor.execute('''
@@ -53,36 +120,350 @@ def init_todo_db():
         )
     ''')
     
+    # 创建归档表（已完成较久的todo及其分类关联）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS todos_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            completed BOOLEAN DEFAULT TRUE,
+            priority TEXT DEFAULT 'medium',
+            due_date DATETIME,
+            created_at DATETIME,
+            updated_at DATETIME,
+            completed_at DATETIME,
+            series_id INTEGER,
+            occurrence_date TEXT,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    _add_column_if_missing(cursor, 'todos_archive', 'series_id', 'INTEGER')
+    _add_column_if_missing(cursor, 'todos_archive', 'occurrence_date', 'TEXT')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS todo_categories_archive (
+            todo_id INTEGER,
+            category_id INTEGER,
+            PRIMARY KEY (todo_id, category_id)
+        )
+    ''')
+    
+    # 创建每日事件汇总表（完成历史）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS todo_daily_stats (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            created INTEGER NOT NULL DEFAULT 0,
+            completed INTEGER NOT NULL DEFAULT 0,
+            reopened INTEGER NOT NULL DEFAULT 0,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    ''')
+    
     # 创建索引以提高查询性能
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_todos_user_id ON todos(user_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_todos_completed ON todos(completed)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_todos_due_date ON todos(due_date)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_categories_user_id ON categories(user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_todos_completed_at ON todos(completed, completed_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_todo_categories_category ON todo_categories(category_id, todo_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_todos_user_position ON todos(user_id, position)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_todos_parent_id ON todos(parent_id)')
+    # 每个系列的每次发生最多物化一行
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_todos_series_occurrence
+        ON todos(series_id, occurrence_date) WHERE series_id IS NOT NULL
+    ''')
+    # 未完成的非重复todo按截止时间排序（到期提醒和 upcoming/overdue 范围查询）
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_todos_pending_due
+        ON todos(due_date) WHERE completed = 0 AND recurrence IS NULL
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_todos_user_pending_due
+        ON todos(user_id, due_date) WHERE completed = 0 AND recurrence IS NULL
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_todos_pending_series
+        ON todos(user_id) WHERE completed = 0 AND recurrence IS NOT NULL
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_todos_archive_series_occurrence
+        ON todos_archive(series_id, occurrence_date) WHERE series_id IS NOT NULL
+    ''')
+    
+    # 为旧数据生成排序键（保持原来按创建时间倒序的顺序）
+    user_ids = [row[0] for row in cursor.execute('SELECT DISTINCT user_id FROM todos WHERE position IS NULL')]
+    for user_id in user_ids:
+        _assign_positions(cursor, user_id)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_todos_archive_user ON todos_archive(user_id, completed_at)')
     
+    stamp_schema(conn, TODO_SCHEMA_VERSION)
     conn.commit()
     conn.close()
-    print("Todo数据库初始化完成")
+    print(f"Todo数据库初始化完成: {os.path.basename(db_path)}")
+
+def _add_column_if_missing(cursor, table, column, definition):
+    """为已有的表补充新增的列"""
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _assign_positions(cursor, user_id):
+    """按当前顺序为用户的全部todo重新生成等间距的排序键"""
+    todo_ids = [row[0] for row in cursor.execute('''
+        SELECT id FROM todos WHERE user_id = ?
+        ORDER BY position IS NULL, position, created_at DESC, id DESC
+    ''', (user_id,))]
+    cursor.executemany(
+        'UPDATE todos SET position = ? WHERE id = ?',
+        zip(evenly_spaced_keys(len(todo_ids)), todo_ids)
+    )
+
+_rebalance_lock = threading.Lock()
+_rebalance_pending = set()
+
+def _schedule_rebalance(user_id):
+    """在后台线程中重新平衡用户的排序键（同一用户只排队一次）"""
+    with _rebalance_lock:
+        if user_id in _rebalance_pending:
+            return
+        _rebalance_pending.add(user_id)
+    
+    def run():
+        try:
+            TodoModel.rebalance_positions(user_id)
+        except Exception as e:
+            print(f"重新平衡排序键出错: {e}")
+        finally:
+            with _rebalance_lock:
+                _rebalance_pending.discard(user_id)
+    
+    threading.Thread(target=run, name=f'rebalance-{user_id}', daemon=True).start()
+
+def _field(todo, name):
+    """读取字典或记录（namedtuple）中的字段"""
+    return todo.get(name) if isinstance(todo, dict) else getattr(todo, name)
+
+def _replace(todo, **changes):
+    """复制字典或记录并修改部分字段"""
+    return dict(todo, **changes) if isinstance(todo, dict) else todo._replace(**changes)
+
+@lru_cache(maxsize=64)
+def todo_record_type(fields):
+    """按投影字段生成记录类型，每行是一个元组，不再为每行创建字典"""
+    return namedtuple('TodoRecord', fields + ('virtual',), defaults=(False,))
+
+def _expand_recurring(conn, todos, window_start, window_end, include_virtual=True):
+    """把列表中的重复任务替换为窗口内的各次发生
+    
+    已物化的发生（包括已归档的）作为普通todo出现在列表中，这里跳过；其余生成 virtual 项，不写入数据库。
+    已完成的系列视为结束，不再生成发生。todos 可以是字典，也可以是包含 RECURRENCE_FIELDS 的记录。
+    """
+    series = [t for t in todos if _field(t, 'recurrence')]
+    if not series:
+        return todos
+    
+    series_ids = [_field(t, 'id') for t in series]
+    placeholders = ', '.join('?' for _ in series_ids)
+    window = [str(window_start)[:10], str(window_end)[:10]]
+    materialized = {
+        (row['series_id'], row['occurrence_date'])
+        for row in conn.execute(f'''
+            SELECT series_id, occurrence_date FROM todos
+            WHERE series_id IN ({placeholders}) AND occurrence_date BETWEEN ? AND ?
+            UNION ALL
+            SELECT series_id, occurrence_date FROM todos_archive
+            WHERE series_id IN ({placeholders}) AND occurrence_date BETWEEN ? AND ?
+        ''', series_ids + window + series_ids + window)
+    }
+    
+    expanded = []
+    for todo in todos:
+        recurrence = _field(todo, 'recurrence')
+        if not recurrence:
+            expanded.append(todo)
+            continue
+        if not include_virtual or _field(todo, 'completed'):
+            continue
+        series_id, due_date = _field(todo, 'id'), _field(todo, 'due_date')
+        for day in occurrences(recurrence, due_date, window_start, window_end):
+            day = day.isoformat()
+            if (series_id, day) in materialized:
+                continue
+            expanded.append(_replace(
+                todo,
+                id=None,
+                series_id=series_id,
+                occurrence_date=day,
+                due_date=occurrence_due_date(due_date, day),
+                recurrence=None,
+                virtual=True
+            ))
+    return expanded
 
-def get_todo_db_connection():
-    """获取todo数据库连接"""
-    conn = sqlite3.connect(TODO_DATABASE_PATH)
+def _todo_list_query(user_id, columns='t.*', completed=None, category_id=None, category_all=None,
+                     category_any=None, category_not=None, order='created', limit=None, after_position=None,
+                     after_id=None):
+    """生成在todos上完成过滤、排序和分页的查询，返回 (query, params, order_by)"""
+    query = f'''
+        SELECT {columns} FROM todos t
+        WHERE t.user_id = ?
+    '''
+    params = [user_id]
+    
+    if completed is not None:
+        query += ' AND t.completed = ?'
+        params.append(completed)
+    
+    # 分类过滤通过 todo_categories(category_id, todo_id) 索引做半连接，
+    # 不影响后面的分类关联，因此每个todo总是返回完整的分类列表
+    all_ids = set(category_all or [])
+    if category_id:
+        all_ids.add(category_id)
+    
+    if all_ids:
+        placeholders = ', '.join('?' for _ in all_ids)
+        query += f'''
+            AND t.id IN (
+                SELECT todo_id FROM todo_categories
+                WHERE category_id IN ({placeholders})
+                GROUP BY todo_id HAVING COUNT(*) = ?
+            )
+        '''
+        params.extend(all_ids)
+        params.append(len(all_ids))
+    
+    if category_any:
+        placeholders = ', '.join('?' for _ in category_any)
+        query += f'''
+            AND t.id IN (
+                SELECT todo_id FROM todo_categories WHERE category_id IN ({placeholders})
+            )
+        '''
+        params.extend(category_any)
+    
+    if category_not:
+        placeholders = ', '.join('?' for _ in category_not)
+        query += f'''
+            AND t.id NOT IN (
+                SELECT todo_id FROM todo_categories WHERE category_id IN ({placeholders})
+            )
+        '''
+        params.extend(category_not)
+    
+    if order == 'manual':
+        # 走 (user_id, position) 索引，分页按 (position, id) 续读，位置键重复时不会跳过同键的行
+        if after_position is not None and after_id is not None:
+            query += ' AND (t.position > ? OR (t.position = ? AND t.id > ?))'
+            params.extend([after_position, after_position, after_id])
+        elif after_position is not None:
+            query += ' AND t.position > ?'
+            params.append(after_position)
+        order_by = 't.position, t.id'
+    else:
+        order_by = 't.created_at DESC'
+    query += f' ORDER BY {order_by}'
+    
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    
+    return query, params, order_by
+
+# todo写入观察者，提交后按 fn(event, user_id, todo) 调用，event 为 created/updated/deleted
+_todo_observers = []
+
+def add_todo_observer(fn):
+    """注册todo写入观察者（如到期提醒调度器）"""
+    _todo_observers.append(fn)
+
+def _notify_observers(event, user_id, todo):
+    for fn in _todo_observers:
+        try:
+            fn(event, user_id, todo)
+        except Exception as e:
+            print(f"todo观察者出错: {e}")
+
+def record_history_events(conn, user_id, created=0, completed=0, reopened=0, deleted=0):
+    """在调用方的事务中累加用户当天的事件计数（完成历史）"""
+    if not (created or completed or reopened or deleted):
+        return
+    conn.execute('''
+        INSERT INTO todo_daily_stats (user_id, day, created, completed, reopened, deleted)
+        VALUES (?, date('now'), ?, ?, ?, ?)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            created = created + excluded.created,
+            completed = completed + excluded.completed,
+            reopened = reopened + excluded.reopened,
+            deleted = deleted + excluded.deleted
+    ''', (user_id, created, completed, reopened, deleted))
+
+def connect_todo_db(db_path):
+    """获取某个分片的数据库连接"""
+    if COLD_START_MODE:
+        ensure_once(db_path, lambda: init_todo_shard(db_path))
+    conn = resource_accounting.connect(db_path)
     conn.row_factory = sqlite3.Row
     return conn
 
+def get_todo_db_connection(user_id):
+    """获取用户所在分片的数据库连接"""
+    return connect_todo_db(shard_path_for_user(user_id))
+
+def begin_user_write(user_id):
+    """获取用户所在分片的连接并开始写事务（BEGIN IMMEDIATE）
+    
+    reshard.py 在源分片写锁内更新分片目录，等待写锁期间用户可能已被迁移，此时写入源分片的数据
+    在 finalize 之前都不可见。取得写锁后重新确认用户所在的分片，已迁移时改到新分片上开始写事务。
+    """
+    while True:
+        db_path = shard_path_for_user(user_id)
+        conn = connect_todo_db(db_path)
+        conn.execute('BEGIN IMMEDIATE')
+        if shard_path_for_user(user_id) == db_path:
+            return conn
+        conn.rollback()
+        conn.close()
+
 class TodoModel:
     """Todo数据模型"""
     
     @staticmethod
-    def create_todo(user_id, title, description=None, priority='medium', due_date=None, category_ids=None):
-        """创建新的todo"""
-        conn = get_todo_db_connection()
+    def create_todo(user_id, title, description=None, priority='medium', due_date=None, category_ids=None,
+                    parent_id=None, recurrence=None):
+        """创建新的todo，parent_id 不存在或不属于该用户时抛出 ValueError
+        
+        recurrence 为重复规则（见 recurrence.py），以 due_date 为第一次发生的日期
+        """
+        if recurrence is not None:
+            if not due_date:
+                raise ValueError('重复任务必须设置截止日期')
+            recurrence = json.dumps(parse_rule(recurrence))
+        
+        conn = begin_user_write(user_id)
         cursor = conn.cursor()
         
+        if parent_id is not None and not cursor.execute('''
+            SELECT 1 FROM todos WHERE id = ? AND user_id = ?
+        ''', (parent_id, user_id)).fetchone():
+            conn.rollback()
+            conn.close()
+            raise ValueError('父任务不存在或无权限')
+        
+        # 新todo排在手动排序的最前面；在写事务内读取最小位置键，并发创建不会得到相同的键
+        first = cursor.execute('''
+            SELECT MIN(position) FROM todos WHERE user_id = ?
+        ''', (user_id,)).fetchone()[0]
+        position = key_before(first) if first else key_between(None, None)
+        
         # 插入todo
         cursor.execute('''
-            INSERT INTO todos (user_id, title, description, priority, due_date)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, title, description, priority, due_date))
+            INSERT INTO todos (user_id, title, description, priority, due_date, position, parent_id, recurrence)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, title, description, priority, due_date, position, parent_id, recurrence))
         
         todo_id = cursor.lastrowid
         
@@ -94,7 +475,9 @@ class TodoModel:
                     VALUES (?, ?)
                 ''', (todo_id, category_id))
         
+        record_history_events(conn, user_id, created=1)
         conn.commit()
+        invalidate_user(user_id)
         
         # 获取创建的todo
         todo = cursor.execute('''
@@ -102,88 +485,501 @@ class TodoModel:
         ''', (todo_id,)).fetchone()
         
         conn.close()
-        return dict(todo)
+        
+        if len(position) > POSITION_REBALANCE_LENGTH:
+            _schedule_rebalance(user_id)
+        
+        todo = dict(todo)
+        _notify_observers('created', user_id, todo)
+        return todo
     
     @staticmethod
-    def get_todos_by_user(user_id, completed=None, category_id=None):
-        """获取用户的todos"""
-        conn = get_todo_db_connection()
+    @tracing.traced('TodoModel.get_todos_by_user')
+    @cached_query('todos')
+    def get_todos_by_user(user_id, completed=None, category_id=None, category_all=None, category_any=None,
+                          category_not=None, order='created', limit=None, after_position=None,
+                          after_id=None, window_start=None, window_end=None):
+        """获取用户的todos
         
-        query = '''
+        category_all: 必须同时属于这些分类
+        category_any: 至少属于其中一个分类
+        category_not: 不属于其中任何一个分类
+        order: created 按创建时间倒序，manual 按用户手动排序
+        limit/after_position/after_id: 手动排序时的分页，为上一页最后一项的 position 和 id
+        window_start/window_end: 给出日期范围时，重复任务展开为范围内的各次发生（未物化的标记为 virtual）
+        """
+        conn = get_todo_db_connection(user_id)
+        
+        # 先在todos上完成过滤、排序和分页，再关联分类
+        query, params, order_by = _todo_list_query(
+            user_id, 't.*', completed, category_id, category_all, category_any, category_not,
+            order, limit, after_position, after_id
+        )
+        
+        query = f'''
             SELECT t.*, GROUP_CONCAT(c.name) as categories
-            FROM todos t
+            FROM ({query}) t
             LEFT JOIN todo_categories tc ON t.id = tc.todo_id
             LEFT JOIN categories c ON tc.category_id = c.id
-            WHERE t.user_id = ?
+            GROUP BY t.id
+            ORDER BY {order_by}
+        '''
+        
+        todos = [dict(todo) for todo in conn.execute(query, params).fetchall()]
+        
+        if window_start and window_end:
+            todos = _expand_recurring(conn, todos, window_start, window_end, include_virtual=not completed)
+        
+        conn.close()
+        return todos
+    
+    @staticmethod
+    @tracing.traced('TodoModel.get_todo_records')
+    @cached_query('todo_records')
+    def get_todo_records(user_id, fields, completed=None, category_id=None, category_all=None,
+                         category_any=None, category_not=None, order='created', limit=None,
+                         after_position=None, after_id=None, window_start=None, window_end=None):
+        """按投影字段获取用户的todos，返回记录（namedtuple）列表，过滤参数同 get_todos_by_user
+        
+        只读取需要的列；category_ids 通过一次关联查询得到整数数组，不再拼接分类名。
+        展开重复任务时额外读取 RECURRENCE_FIELDS，记录中包含这些字段但调用方只需输出 fields。
+        """
+        fields = tuple(fields)
+        unknown = [f for f in fields if f not in TODO_LIST_FIELDS]
+        if unknown:
+            raise ValueError(f"不支持的字段: {', '.join(unknown)}")
+        
+        expand = bool(window_start and window_end)
+        want_categories = 'category_ids' in fields
+        columns = [f for f in fields if f != 'category_ids']
+        for name in (RECURRENCE_FIELDS if expand else ()) + (('id',) if want_categories else ()):
+            if name not in columns:
+                columns.append(name)
+        
+        conn = get_todo_db_connection(user_id)
+        query, params, _ = _todo_list_query(
+            user_id, ', '.join(f't.{name}' for name in columns), completed, category_id,
+            category_all, category_any, category_not, order, limit, after_position, after_id
+        )
+        # 直接读取元组，不为每行创建 sqlite3.Row
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(query, params).fetchall()
+        
+        if want_categories:
+            record_type = todo_record_type(tuple(columns) + ('category_ids',))
+            id_index = columns.index('id')
+            links = {}
+            # 关联 categories，忽略分类删除前遗留的关联
+            for todo_id, category_id in cursor.execute('''
+                SELECT tc.todo_id, tc.category_id FROM todo_categories tc
+                JOIN categories c ON c.id = tc.category_id
+                WHERE tc.todo_id IN (SELECT value FROM json_each(?))
+                ORDER BY tc.category_id
+            ''', (json.dumps([row[id_index] for row in rows]),)):
+                links.setdefault(todo_id, []).append(category_id)
+            records = [record_type(*row, links.get(row[id_index], [])) for row in rows]
+        else:
+            record_type = todo_record_type(tuple(columns))
+            records = [record_type(*row) for row in rows]
+        
+        if expand:
+            records = _expand_recurring(conn, records, window_start, window_end, include_virtual=not completed)
+        
+        conn.close()
+        return records
+    
+    @staticmethod
+    def get_due_todos(user_id, due_from=None, due_before=None, limit=100):
+        """按截止时间范围获取未完成的todo（due_from <= due_date < due_before），按截止时间排序
+        
+        非重复todo走 (user_id, due_date) 部分索引；重复任务只读取该用户未完成的系列，
+        把范围内未物化的发生作为 virtual 项合并进来。时间为ISO字符串，与 due_date 按字符串比较。
+        """
+        conn = get_todo_db_connection(user_id)
+        
+        query = '''
+            SELECT * FROM todos
+            WHERE user_id = ? AND completed = 0 AND recurrence IS NULL AND due_date IS NOT NULL
         '''
         params = [user_id]
+        if due_from is not None:
+            query += ' AND due_date >= ?'
+            params.append(due_from)
+        if due_before is not None:
+            query += ' AND due_date < ?'
+            params.append(due_before)
+        query += ' ORDER BY due_date LIMIT ?'
+        params.append(limit)
+        todos = [dict(todo) for todo in conn.execute(query, params).fetchall()]
         
-        if completed is not None:
-            query += ' AND t.completed = ?'
-            params.append(completed)
+        series = [dict(todo) for todo in conn.execute('''
+            SELECT * FROM todos WHERE user_id = ? AND completed = 0 AND recurrence IS NOT NULL
+        ''', (user_id,)).fetchall()]
+        if series:
+            # 没有下界时只展开当天起的发生，更早未完成的发生不计为过期
+            window_start = (due_from or datetime.now().isoformat())[:10]
+            window_end = (due_before or window_start)[:10]
+            todos += [
+                todo for todo in _expand_recurring(conn, series, window_start, window_end)
+                if (due_from is None or todo['due_date'] >= due_from)
+                and (due_before is None or todo['due_date'] < due_before)
+            ]
         
-        if category_id:
-            query += ' AND tc.category_id = ?'
-            params.append(category_id)
+        conn.close()
+        todos.sort(key=lambda todo: todo['due_date'])
+        return todos[:limit]
+    
+    @staticmethod
+    def count_overdue(user_id, now):
+        """统计截止时间早于 now 的未完成非重复todo（部分索引上的范围计数）"""
+        conn = get_todo_db_connection(user_id)
+        count = conn.execute('''
+            SELECT COUNT(*) FROM todos
+            WHERE user_id = ? AND completed = 0 AND recurrence IS NULL AND due_date < ?
+        ''', (user_id, now)).fetchone()[0]
+        conn.close()
+        return count
+    
+    @staticmethod
+    def materialize_occurrence(series_id, user_id, occurrence_date):
+        """把重复任务的一次发生物化为真实的todo行（已物化时直接返回该行）
         
-        query += ' GROUP BY t.id ORDER BY t.created_at DESC'
+        系列不存在或该日期不是一次发生时返回 None
+        """
+        conn = begin_user_write(user_id)
+        
+        series = conn.execute('''
+            SELECT * FROM todos WHERE id = ? AND user_id = ? AND recurrence IS NOT NULL
+        ''', (series_id, user_id)).fetchone()
+        
+        if not series or not is_occurrence(series['recurrence'], series['due_date'], occurrence_date):
+            conn.rollback()
+            conn.close()
+            return None
+        
+        occurrence_date = occurrence_date[:10]
+        
+        try:
+            # 在写事务内为物化的行生成紧跟在系列之后的独立位置键，与系列共用位置键会让分页游标跳过这些行
+            next_position = conn.execute('''
+                SELECT MIN(position) FROM todos WHERE user_id = ? AND position > ?
+            ''', (user_id, series['position'])).fetchone()[0]
+            position = key_between(series['position'], next_position)
+
+            # 唯一索引保证并发物化同一次发生只会插入一行
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO todos
+                    (user_id, title, description, priority, due_date, position, parent_id, series_id, occurrence_date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, series['title'], series['description'], series['priority'],
+                  occurrence_due_date(series['due_date'], occurrence_date), position,
+                  series['parent_id'], series_id, occurrence_date))
+            
+            if cursor.rowcount > 0:
+                conn.execute('''
+                    INSERT INTO todo_categories (todo_id, category_id)
+                    SELECT ?, category_id FROM todo_categories WHERE todo_id = ?
+                ''', (cursor.lastrowid, series_id))
+                # 物化只是把系列中已有的一次发生落成真实行，不是新建任务，不计入创建数
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            conn.close()
+            raise
         
-        todos = conn.execute(query, params).fetchall()
+        todo = conn.execute('''
+            SELECT * FROM todos WHERE series_id = ? AND occurrence_date = ?
+        ''', (series_id, occurrence_date)).fetchone()
         conn.close()
         
-        return [dict(todo) for todo in todos]
+        invalidate_user(user_id)
+        todo = dict(todo)
+        _notify_observers('created', user_id, todo)
+        return todo
     
     @staticmethod
     def update_todo(todo_id, user_id, **kwargs):
         """更新todo"""
-        conn = get_todo_db_connection()
-        cursor = conn.cursor()
+        fields = {key: value for key, value in kwargs.items() if key in UPDATABLE_FIELDS}
+        return TodoModel.patch_todo(todo_id, user_id, set_fields=fields)
+    
+    @staticmethod
+    def toggle_todo(todo_id, user_id):
+        """原子地切换todo完成状态"""
+        return TodoModel.patch_todo(todo_id, user_id, toggle=['completed'])
+    
+    @staticmethod
+    def patch_todo(todo_id, user_id, set_fields=None, toggle=None, increment=None):
+        """用单条 UPDATE ... RETURNING 原子地修改字段
+        
+        set_fields: 直接赋值的字段，如 {'title': '新标题'}
+        toggle: 取反的布尔字段，如 ['completed']
+        increment: 按步长调整的字段，如 {'priority': 1} 把优先级提高一级（在low/high处截断）
+        
+        字段不合法时抛出 ValueError；todo不存在或无权限时返回 None
+        """
+        set_fields = set_fields or {}
+        toggle = list(toggle or [])
+        increment = increment or {}
+        
+        touched = list(set_fields) + toggle + list(increment)
+        if len(touched) != len(set(touched)):
+            raise ValueError('同一字段只能进行一种修改')
         
-        # 构建更新语句
         set_clauses = []
         params = []
         
-        for key, value in kwargs.items():
-            if key in ['title', 'description', 'completed', 'priority', 'due_date']:
-                set_clauses.append(f'{key} = ?')
-                params.append(value)
+        for key, value in set_fields.items():
+            if key not in UPDATABLE_FIELDS:
+                raise ValueError(f'字段 {key} 不可修改')
+            set_clauses.append(f'{key} = ?')
+            params.append(value)
+        
+        for key in toggle:
+            if key not in TOGGLEABLE_FIELDS:
+                raise ValueError(f'字段 {key} 不可切换')
+            set_clauses.append(f'{key} = NOT {key}')
+        
+        for key, step in increment.items():
+            if key not in INCREMENTABLE_FIELDS or isinstance(step, bool) or not isinstance(step, int):
+                raise ValueError(f'字段 {key} 不可按整数步长调整')
+            set_clauses.append(INCREMENTABLE_FIELDS[key])
+            params.append(step)
+        
+        # 记录完成时间，供归档判断使用（SET右侧引用的是修改前的值）
+        if 'completed' in set_fields:
+            set_clauses.append('completed_at = CASE WHEN ? THEN COALESCE(completed_at, CURRENT_TIMESTAMP) ELSE NULL END')
+            params.append(set_fields['completed'])
+        elif 'completed' in toggle:
+            set_clauses.append('completed_at = CASE WHEN completed THEN NULL ELSE CURRENT_TIMESTAMP END')
         
         if set_clauses:
             set_clauses.append('updated_at = CURRENT_TIMESTAMP')
             params.extend([todo_id, user_id])
+            conn = begin_user_write(user_id)
             
-            query = f'''
-                UPDATE todos 
-                SET {', '.join(set_clauses)}
-                WHERE id = ? AND user_id = ?
-            '''
+            try:
+                # 直接赋值完成状态时需要知道原值才能记录完成/重新打开事件，
+                # 在写锁内读取，读和写之间不会被其他请求插入
+                old_completed = None
+                if 'completed' in set_fields:
+                    row = conn.execute('''
+                        SELECT completed FROM todos WHERE id = ? AND user_id = ?
+                    ''', (todo_id, user_id)).fetchone()
+                    old_completed = bool(row['completed']) if row else None
+                
+                todo = conn.execute(f'''
+                    UPDATE todos
+                    SET {', '.join(set_clauses)}
+                    WHERE id = ? AND user_id = ?
+                    RETURNING *
+                ''', params).fetchone()
+                
+                if todo and ('completed' in set_fields or 'completed' in toggle):
+                    new_completed = bool(todo['completed'])
+                    changed = 'completed' in toggle or old_completed != new_completed
+                    completed_count = 1 if changed and new_completed else 0
+                    reopened_count = 1 if changed and not new_completed else 0
+                    
+                    # 完成父任务时在同一事务中批量完成整棵子树
+                    if new_completed:
+                        changes_before = conn.total_changes
+                        conn.execute(SUBTREE_CTE + '''
+                            UPDATE todos
+                            SET completed = 1,
+                                completed_at = COALESCE(completed_at, CURRENT_TIMESTAMP),
+                                updated_at = CURRENT_TIMESTAMP
+                            WHERE id IN (SELECT id FROM subtree WHERE depth > 0) AND completed = 0
+                        ''', (todo_id, user_id))
+                        completed_count += conn.total_changes - changes_before
+                    
+                    record_history_events(conn, user_id, completed=completed_count, reopened=reopened_count)
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                conn.close()
+                raise
+            
+            if todo:
+                invalidate_user(user_id)
+                _notify_observers('updated', user_id, dict(todo))
+        else:
+            conn = get_todo_db_connection(user_id)
+            todo = conn.execute('''
+                SELECT * FROM todos WHERE id = ? AND user_id = ?
+            ''', (todo_id, user_id)).fetchone()
+        
+        conn.close()
+        return dict(todo) if todo else None
+    
+    @staticmethod
+    def move_todo(todo_id, user_id, after_id=None, before_id=None):
+        """把todo移动到 after_id 之后、before_id 之前，只修改这一行的排序键
+        
+        只给出一侧时，另一侧取该位置相邻的todo；两者都为空时移到最前面。
+        after_id 排在 before_id 之后时抛出 ValueError；todo或相邻todo不存在时返回 None
+        """
+        # 读取相邻键和更新在同一个写事务中完成，避免并发移动得到相同的键
+        conn = begin_user_write(user_id)
+        
+        try:
+            def position_of(other_id):
+                row = conn.execute('''
+                    SELECT position FROM todos WHERE id = ? AND user_id = ?
+                ''', (other_id, user_id)).fetchone()
+                return row['position'] if row else None
+            
+            def neighbours():
+                lower = position_of(after_id) if after_id else None
+                upper = position_of(before_id) if before_id else None
+                if after_id and not before_id and lower is not None:
+                    upper = conn.execute('''
+                        SELECT MIN(position) FROM todos
+                        WHERE user_id = ? AND position > ? AND id != ?
+                    ''', (user_id, lower, todo_id)).fetchone()[0]
+                elif before_id and not after_id and upper is not None:
+                    lower = conn.execute('''
+                        SELECT MAX(position) FROM todos
+                        WHERE user_id = ? AND position < ? AND id != ?
+                    ''', (user_id, upper, todo_id)).fetchone()[0]
+                elif not after_id and not before_id:
+                    upper = conn.execute('''
+                        SELECT MIN(position) FROM todos WHERE user_id = ? AND id != ?
+                    ''', (user_id, todo_id)).fetchone()[0]
+                return lower, upper
+            
+            lower, upper = neighbours()
+            if (after_id and lower is None) or (before_id and upper is None):
+                conn.rollback()
+                return None
             
-            cursor.execute(query, params)
+            if lower is not None and upper is not None and lower >= upper:
+                if lower > upper:
+                    raise ValueError('after_id 必须排在 before_id 之前')
+                # 相邻键相同（并发插入导致），在同一事务中重新平衡后再取一次
+                _assign_positions(conn, user_id)
+                lower, upper = neighbours()
+            
+            position = key_between(lower, upper)
+            todo = conn.execute('''
+                UPDATE todos SET position = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND user_id = ?
+                RETURNING *
+            ''', (position, todo_id, user_id)).fetchone()
             conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
         
-        # 获取更新后的todo
-        todo = cursor.execute('''
-            SELECT * FROM todos WHERE id = ? AND user_id = ?
+        if not todo:
+            return None
+        
+        invalidate_user(user_id)
+        if len(position) > POSITION_REBALANCE_LENGTH:
+            _schedule_rebalance(user_id)
+        return dict(todo)
+    
+    @staticmethod
+    def rebalance_positions(user_id):
+        """重新为用户的全部todo生成等间距的短排序键"""
+        conn = begin_user_write(user_id)
+        try:
+            _assign_positions(conn, user_id)
+            conn.commit()
+        finally:
+            conn.close()
+        invalidate_user(user_id)
+    
+    @staticmethod
+    def delete_todo(todo_id, user_id):
+        """删除todo及其全部子任务"""
+        return TodoModel.delete_subtree(todo_id, user_id) > 0
+    
+    @staticmethod
+    def delete_subtree(todo_id, user_id):
+        """在一个事务中批量删除子树（含分类关联），返回删除的todo数量"""
+        conn = begin_user_write(user_id)
+        
+        try:
+            conn.execute(SUBTREE_CTE + '''
+                DELETE FROM todo_categories WHERE todo_id IN (SELECT id FROM subtree)
+            ''', (todo_id, user_id))
+            # 以WITH开头的语句不会设置cursor.rowcount，改用total_changes计算
+            changes_before = conn.total_changes
+            conn.execute(SUBTREE_CTE + '''
+                DELETE FROM todos WHERE id IN (SELECT id FROM subtree)
+            ''', (todo_id, user_id))
+            deleted = conn.total_changes - changes_before
+            record_history_events(conn, user_id, deleted=deleted)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        if deleted:
+            invalidate_user(user_id)
+            _notify_observers('deleted', user_id, {'id': todo_id})
+        
+        return deleted
+    
+    @staticmethod
+    def get_subtree(todo_id, user_id):
+        """获取以todo为根的整棵子树（按层级和手动顺序排列，带 depth）"""
+        conn = get_todo_db_connection(user_id)
+        
+        todos = conn.execute(SUBTREE_CTE + '''
+            SELECT t.*, s.depth
+            FROM subtree s JOIN todos t ON t.id = s.id
+            ORDER BY s.depth, t.position, t.id
+        ''', (todo_id, user_id)).fetchall()
+        
+        conn.close()
+        return [dict(todo) for todo in todos]
+    
+    @staticmethod
+    def get_subtree_stats(todo_id, user_id):
+        """统计子树（含根节点）的任务数和完成数"""
+        conn = get_todo_db_connection(user_id)
+        
+        stats = conn.execute(SUBTREE_CTE + '''
+            SELECT COUNT(*) as total, COALESCE(SUM(t.completed), 0) as completed
+            FROM subtree s JOIN todos t ON t.id = s.id
         ''', (todo_id, user_id)).fetchone()
         
         conn.close()
-        return dict(todo) if todo else None
+        return dict(stats)
     
     @staticmethod
-    def delete_todo(todo_id, user_id):
-        """删除todo"""
-        conn = get_todo_db_connection()
-        cursor = conn.cursor()
+    def move_subtree(todo_id, user_id, new_parent_id):
+        """把todo（连同子树）挂到新的父任务下，new_parent_id 为 None 时成为顶层任务
         
-        cursor.execute('''
-            DELETE FROM todos WHERE id = ? AND user_id = ?
-        ''', (todo_id, user_id))
+        新父任务不存在、不属于该用户或位于该子树内（会形成循环）时返回 None
+        """
+        conn = begin_user_write(user_id)
         
-        deleted = cursor.rowcount > 0
+        todo = conn.execute(SUBTREE_CTE + '''
+            UPDATE todos SET parent_id = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND user_id = ?
+              AND (? IS NULL OR (
+                  EXISTS (SELECT 1 FROM todos WHERE id = ? AND user_id = ?)
+                  AND ? NOT IN (SELECT id FROM subtree)
+              ))
+            RETURNING *
+        ''', (todo_id, user_id, new_parent_id, todo_id, user_id,
+              new_parent_id, new_parent_id, user_id, new_parent_id)).fetchone()
         conn.commit()
         conn.close()
         
-        return deleted
+        if not todo:
+            return None
+        
+        invalidate_user(user_id)
+        return dict(todo)
 
 class CategoryModel:
     """分类数据模型"""
@@ -191,7 +987,7 @@ class CategoryModel:
     @staticmethod
     def create_category(user_id, name, color='#007bff'):
         """创建新分类"""
-        conn = get_todo_db_connection()
+        conn = begin_user_write(user_id)
         cursor = conn.cursor()
         
         try:
@@ -202,6 +998,7 @@ class CategoryModel:
             
             category_id = cursor.lastrowid
             conn.commit()
+            invalidate_user(user_id)
             
             # 获取创建的分类
             category = cursor.execute('''
@@ -211,13 +1008,16 @@ class CategoryModel:
             conn.close()
             return dict(category)
         except sqlite3.IntegrityError:
+            conn.rollback()
             conn.close()
             return None
     
     @staticmethod
+    @tracing.traced('CategoryModel.get_categories_by_user')
+    @cached_query('categories')
     def get_categories_by_user(user_id):
         """获取用户的分类"""
-        conn = get_todo_db_connection()
+        conn = get_todo_db_connection(user_id)
         
         categories = conn.execute('''
             SELECT c.*, COUNT(tc.todo_id) as todo_count
@@ -234,15 +1034,26 @@ class CategoryModel:
     @staticmethod
     def delete_category(category_id, user_id):
         """删除分类"""
-        conn = get_todo_db_connection()
+        conn = begin_user_write(user_id)
         cursor = conn.cursor()
         
-        cursor.execute('''
-            DELETE FROM categories WHERE id = ? AND user_id = ?
-        ''', (category_id, user_id))
+        try:
+            cursor.execute('''
+                DELETE FROM categories WHERE id = ? AND user_id = ?
+            ''', (category_id, user_id))
+            deleted = cursor.rowcount > 0
+            # 外键未启用，关联记录需要手动删除
+            if deleted:
+                cursor.execute('DELETE FROM todo_categories WHERE category_id = ?', (category_id,))
+                cursor.execute('DELETE FROM todo_categories_archive WHERE category_id = ?', (category_id,))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
         
-        deleted = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
+        if deleted:
+            invalidate_user(user_id)
         
         return deleted
\ No newline at end of file
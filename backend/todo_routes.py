@@ -1,13 +1,71 @@
-from flask import Blueprint, request, jsonify
-from todo_models import TodoModel, CategoryModel, init_todo_db
-from auth_decorators import token_required
-from datetime import datetime
+from flask import Blueprint, request, jsonify, current_app
+from todo_models import TodoModel, CategoryModel, init_todo_db, TODO_LIST_FIELDS
+from todo_archive import ArchiveModel
+from todo_history import HistoryModel, GRANULARITIES, MAX_HISTORY_DAYS, default_history_window
+from query_cache import query_cache, freeze_key, sync_invalidations
+from shard_router import shard_for_user
+from single_flight import single_flight
+from auth_decorators import token_required, admin_required
+from idempotency import idempotent
+from cold_start import COLD_START_MODE
+from recurrence import parse_date, MAX_WINDOW_DAYS
+from datetime import datetime, date, timedelta
 
 # 创建蓝图
 todo_bp = Blueprint('todo', __name__, url_prefix='/api/todo')
 
-# 初始化数据库
-init_todo_db()
+# 初始化数据库（冷启动模式下推迟到首次获取连接时）
+if not COLD_START_MODE:
+    init_todo_db()
+
+def parse_window(args, default_today=False):
+    """解析 from/to 日期范围参数，返回 (window_start, window_end)，不合法时抛出 ValueError"""
+    if not args.get('from') and not args.get('to'):
+        if default_today:
+            today = date.today().isoformat()
+            return today, today
+        return None, None
+    
+    window_start = parse_date(args.get('from') or args.get('to'))
+    window_end = parse_date(args.get('to') or args.get('from'))
+    if window_start > window_end:
+        raise ValueError('from 不能晚于 to')
+    if (window_end - window_start).days > MAX_WINDOW_DAYS:
+        raise ValueError(f'日期范围不能超过 {MAX_WINDOW_DAYS} 天')
+    return window_start.isoformat(), window_end.isoformat()
+
+def coalesced_json(name, user_id, compute, **params):
+    """相同用户、相同参数的并发读请求只计算和序列化一次，共享响应字节
+    
+    键中包含用户当前的分片和缓存代数，写入或迁移后到达的请求不会拿到之前开始的计算结果
+    """
+    # 先确定分片并处理进程外的失效记录：分片目录或失效记录有变化时会先清除缓存、递增代数
+    shard = shard_for_user(user_id)
+    sync_invalidations()
+    key = (name, user_id, shard, query_cache.generation(user_id), freeze_key(params))
+    body, _ = single_flight.do(key, lambda: jsonify(compute()).get_data())
+    return current_app.response_class(body, mimetype='application/json')
+
+# 只指定 format=columns 时列表视图使用的字段
+DEFAULT_LIST_FIELDS = ('id', 'title', 'completed', 'priority', 'due_date', 'category_ids')
+
+def serialize_records(records, fields, layout):
+    """把记录序列化为行（每项一个对象）或列（每个字段一个数组）"""
+    record_type_fields = records[0]._fields if records else ()
+    if layout == 'columns':
+        transposed = dict(zip(record_type_fields, zip(*records)))
+        return {
+            'count': len(records),
+            'columns': {name: list(transposed.get(name, ())) for name in fields}
+        }
+    indexes = [record_type_fields.index(name) for name in fields] if records else []
+    return [dict(zip(fields, (record[i] for i in indexes))) for record in records]
+
+def parse_id_list(value):
+    """解析逗号分隔的id列表，如 1,2,3"""
+    if not value:
+        return None
+    return tuple(sorted({int(v) for v in value.split(',') if v.strip()}))
 
 @todo_bp.route('/todos', methods=['GET'])
 @token_required
@@ -28,11 +86,71 @@ def get_todos():
         except ValueError:
             category_id = None
     
-    todos = TodoModel.get_todos_by_user(user_id, completed, category_id)
-    return jsonify(todos)
+    # 多分类过滤：category_all 为与，category_any 为或，category_not 为非
+    try:
+        category_all = parse_id_list(request.args.get('category_all'))
+        category_any = parse_id_list(request.args.get('category_any'))
+        category_not = parse_id_list(request.args.get('category_not'))
+    except ValueError:
+        return jsonify({'detail': '分类id必须是逗号分隔的整数'}), 400
+    
+    # 排序与分页：order=manual 时按手动排序，after/after_id 为上一页最后一项的 position 和 id
+    order = request.args.get('order', 'created')
+    if order not in ('created', 'manual'):
+        return jsonify({'detail': '排序方式必须是 created 或 manual'}), 400
+    
+    try:
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+        after_id = int(request.args['after_id']) if request.args.get('after_id') else None
+    except ValueError:
+        return jsonify({'detail': '分页参数必须是整数'}), 400
+    
+    # 给出 from/to 时，重复任务展开为该日期范围内的各次发生
+    try:
+        window_start, window_end = parse_window(request.args)
+    except ValueError as e:
+        return jsonify({'detail': str(e)}), 400
+    
+    # 稀疏字段：fields 只返回指定字段，format=columns 按列返回
+    layout = request.args.get('format', 'rows')
+    if layout not in ('rows', 'columns'):
+        return jsonify({'detail': '返回格式必须是 rows 或 columns'}), 400
+    fields = None
+    if request.args.get('fields'):
+        fields = tuple(dict.fromkeys(f.strip() for f in request.args['fields'].split(',') if f.strip()))
+        unknown = [f for f in fields if f not in TODO_LIST_FIELDS]
+        if unknown:
+            return jsonify({'detail': f"不支持的字段: {', '.join(unknown)}"}), 400
+    elif layout == 'columns':
+        fields = DEFAULT_LIST_FIELDS
+    
+    params = dict(
+        completed=completed,
+        category_id=category_id,
+        category_all=category_all,
+        category_any=category_any,
+        category_not=category_not,
+        order=order,
+        limit=limit,
+        after_position=request.args.get('after') if order == 'manual' else None,
+        after_id=after_id if order == 'manual' else None,
+        window_start=window_start,
+        window_end=window_end
+    )
+    if fields is None:
+        return coalesced_json('todos', user_id, lambda: TodoModel.get_todos_by_user(user_id, **params), **params)
+    
+    # 展开重复任务时输出 virtual 标记
+    output_fields = fields + ('virtual',) if window_start else fields
+    return coalesced_json(
+        'todo_records', user_id,
+        lambda: serialize_records(TodoModel.get_todo_records(user_id, fields, **params), output_fields, layout),
+        fields=fields, layout=layout, **params
+    )
 
 @todo_bp.route('/todos', methods=['POST'])
 @token_required
+@idempotent
 def create_todo():
     """创建新的todo"""
     user_id = request.current_user['user_id']
@@ -46,6 +164,8 @@ def create_todo():
     priority = data.get('priority', 'medium')
     due_date = data.get('due_date')
     category_ids = data.get('category_ids', [])
+    parent_id = data.get('parent_id')
+    recurrence = data.get('recurrence')
     
     # 验证优先级
     if priority not in ['low', 'medium', 'high']:
@@ -58,17 +178,37 @@ def create_todo():
         except ValueError:
             return jsonify({'detail': '日期格式不正确'}), 400
     
-    todo = TodoModel.create_todo(
-        user_id=user_id,
-        title=title,
-        description=description,
-        priority=priority,
-        due_date=due_date,
-        category_ids=category_ids
-    )
+    try:
+        todo = TodoModel.create_todo(
+            user_id=user_id,
+            title=title,
+            description=description,
+            priority=priority,
+            due_date=due_date,
+            category_ids=category_ids,
+            parent_id=parent_id,
+            recurrence=recurrence
+        )
+    except ValueError as e:
+        return jsonify({'detail': str(e)}), 400
     
     return jsonify(todo), 201
 
+def validate_todo_fields(data):
+    """验证todo字段，返回错误信息或None"""
+    # 验证优先级
+    if 'priority' in data and data['priority'] not in ['low', 'medium', 'high']:
+        return '优先级必须是 low, medium 或 high'
+    
+    # 验证日期格式
+    if 'due_date' in data and data['due_date']:
+        try:
+            datetime.fromisoformat(data['due_date'].replace('Z', '+00:00'))
+        except (ValueError, AttributeError):
+            return '日期格式不正确'
+    
+    return None
+
 @todo_bp.route('/todos/<int:todo_id>', methods=['PUT'])
 @token_required
 def update_todo(todo_id):
@@ -79,16 +219,9 @@ def update_todo(todo_id):
     if not data:
         return jsonify({'detail': '请提供更新数据'}), 400
     
-    # 验证优先级
-    if 'priority' in data and data['priority'] not in ['low', 'medium', 'high']:
-        return jsonify({'detail': '优先级必须是 low, medium 或 high'}), 400
-    
-    # 验证日期格式
-    if 'due_date' in data and data['due_date']:
-        try:
-            datetime.fromisoformat(data['due_date'].replace('Z', '+00:00'))
-        except ValueError:
-            return jsonify({'detail': '日期格式不正确'}), 400
+    error = validate_todo_fields(data)
+    if error:
+        return jsonify({'detail': error}), 400
     
     todo = TodoModel.update_todo(todo_id, user_id, **data)
     
@@ -97,6 +230,40 @@ def update_todo(todo_id):
     
     return jsonify(todo)
 
+@todo_bp.route('/todos/<int:todo_id>', methods=['PATCH'])
+@token_required
+def patch_todo(todo_id):
+    """原子地修改todo字段
+
+    请求体示例: {"set": {"title": "新标题"}, "toggle": ["completed"], "increment": {"priority": 1}}
+    """
+    user_id = request.current_user['user_id']
+    data = request.get_json()
+    
+    if not data or not any(k in data for k in ('set', 'toggle', 'increment')):
+        return jsonify({'detail': '请提供 set、toggle 或 increment'}), 400
+    
+    set_fields = data.get('set') or {}
+    toggle = data.get('toggle') or []
+    increment = data.get('increment') or {}
+    
+    if not isinstance(set_fields, dict) or not isinstance(toggle, list) or not isinstance(increment, dict):
+        return jsonify({'detail': 'set和increment必须是对象，toggle必须是数组'}), 400
+    
+    error = validate_todo_fields(set_fields)
+    if error:
+        return jsonify({'detail': error}), 400
+    
+    try:
+        todo = TodoModel.patch_todo(todo_id, user_id, set_fields, toggle, increment)
+    except ValueError as e:
+        return jsonify({'detail': str(e)}), 400
+    
+    if not todo:
+        return jsonify({'detail': 'Todo不存在或无权限'}), 404
+    
+    return jsonify(todo)
+
 @todo_bp.route('/todos/<int:todo_id>', methods=['DELETE'])
 @token_required
 def delete_todo(todo_id):
@@ -116,30 +283,141 @@ def toggle_todo(todo_id):
     """切换todo完成状态"""
     user_id = request.current_user['user_id']
     
-    # 先获取当前状态
-    todos = TodoModel.get_todos_by_user(user_id)
-    current_todo = next((t for t in todos if t['id'] == todo_id), None)
+    # 单条UPDATE原子切换，并发点击不会丢失更新
+    todo = TodoModel.toggle_todo(todo_id, user_id)
     
-    if not current_todo:
+    if not todo:
         return jsonify({'detail': 'Todo不存在或无权限'}), 404
     
-    # 切换完成状态
-    new_completed = not current_todo['completed']
-    todo = TodoModel.update_todo(todo_id, user_id, completed=new_completed)
+    return jsonify(todo)
+
+@todo_bp.route('/archive', methods=['GET'])
+@token_required
+def get_archived_todos():
+    """分页获取已归档的todos"""
+    user_id = request.current_user['user_id']
+    
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('page_size', 20)), 1), 100)
+    except ValueError:
+        return jsonify({'detail': '分页参数必须是整数'}), 400
+    
+    return jsonify(ArchiveModel.get_archived_todos(user_id, page, page_size))
+
+@todo_bp.route('/todos/<int:todo_id>/reorder', methods=['POST'])
+@token_required
+def reorder_todo(todo_id):
+    """手动调整todo顺序：移动到 after_id 之后 / before_id 之前，只写一行"""
+    user_id = request.current_user['user_id']
+    data = request.get_json() or {}
+    
+    after_id = data.get('after_id')
+    before_id = data.get('before_id')
+    
+    try:
+        todo = TodoModel.move_todo(todo_id, user_id, after_id=after_id, before_id=before_id)
+    except ValueError as e:
+        return jsonify({'detail': str(e)}), 400
+    
+    if not todo:
+        return jsonify({'detail': 'Todo不存在或无权限'}), 404
     
     return jsonify(todo)
 
+@todo_bp.route('/todos/<int:todo_id>/subtree', methods=['GET'])
+@token_required
+def get_subtree(todo_id):
+    """获取todo及其全部子任务"""
+    user_id = request.current_user['user_id']
+    
+    todos = TodoModel.get_subtree(todo_id, user_id)
+    if not todos:
+        return jsonify({'detail': 'Todo不存在或无权限'}), 404
+    
+    completed = sum(1 for t in todos if t['completed'])
+    return jsonify({'todos': todos, 'total': len(todos), 'completed': completed})
+
+@todo_bp.route('/todos/<int:todo_id>/subtree/stats', methods=['GET'])
+@token_required
+def get_subtree_stats(todo_id):
+    """获取子树的任务数和完成数（一条查询，不加载任务内容）"""
+    user_id = request.current_user['user_id']
+    
+    stats = TodoModel.get_subtree_stats(todo_id, user_id)
+    if not stats['total']:
+        return jsonify({'detail': 'Todo不存在或无权限'}), 404
+    
+    return jsonify(stats)
+
+@todo_bp.route('/todos/<int:todo_id>/parent', methods=['PATCH'])
+@token_required
+def move_subtree(todo_id):
+    """移动todo（连同子任务）到新的父任务下，parent_id 为 null 时成为顶层任务"""
+    user_id = request.current_user['user_id']
+    data = request.get_json()
+    
+    if not data or 'parent_id' not in data:
+        return jsonify({'detail': '请提供 parent_id'}), 400
+    
+    todo = TodoModel.move_subtree(todo_id, user_id, data['parent_id'])
+    
+    if not todo:
+        return jsonify({'detail': 'Todo或父任务不存在、无权限，或会形成循环'}), 400
+    
+    return jsonify(todo)
+
+@todo_bp.route('/todos/<int:series_id>/occurrences/<occurrence_date>', methods=['PUT'])
+@token_required
+def update_occurrence(series_id, occurrence_date):
+    """修改重复任务的某一次发生（首次修改时物化为真实的todo）"""
+    user_id = request.current_user['user_id']
+    data = request.get_json()
+    
+    if not data:
+        return jsonify({'detail': '请提供更新数据'}), 400
+    
+    error = validate_todo_fields(data)
+    if error:
+        return jsonify({'detail': error}), 400
+    
+    try:
+        occurrence = TodoModel.materialize_occurrence(series_id, user_id, occurrence_date)
+    except ValueError as e:
+        return jsonify({'detail': str(e)}), 400
+    if not occurrence:
+        return jsonify({'detail': '重复任务不存在，或该日期不是它的一次发生'}), 404
+    
+    todo = TodoModel.update_todo(occurrence['id'], user_id, **data)
+    return jsonify(todo)
+
+@todo_bp.route('/todos/<int:series_id>/occurrences/<occurrence_date>/toggle', methods=['PATCH'])
+@token_required
+def toggle_occurrence(series_id, occurrence_date):
+    """切换重复任务某一次发生的完成状态（首次修改时物化为真实的todo）"""
+    user_id = request.current_user['user_id']
+    
+    try:
+        occurrence = TodoModel.materialize_occurrence(series_id, user_id, occurrence_date)
+    except ValueError as e:
+        return jsonify({'detail': str(e)}), 400
+    if not occurrence:
+        return jsonify({'detail': '重复任务不存在，或该日期不是它的一次发生'}), 404
+    
+    todo = TodoModel.toggle_todo(occurrence['id'], user_id)
+    return jsonify(todo)
+
 # 分类相关路由
 @todo_bp.route('/categories', methods=['GET'])
 @token_required
 def get_categories():
     """获取用户的分类"""
     user_id = request.current_user['user_id']
-    categories = CategoryModel.get_categories_by_user(user_id)
-    return jsonify(categories)
+    return coalesced_json('categories', user_id, lambda: CategoryModel.get_categories_by_user(user_id))
 
 @todo_bp.route('/categories', methods=['POST'])
 @token_required
+@idempotent
 def create_category():
     """创建新分类"""
     user_id = request.current_user['user_id']
@@ -177,7 +455,18 @@ def get_stats():
     """获取todo统计信息"""
     user_id = request.current_user['user_id']
     
-    all_todos = TodoModel.get_todos_by_user(user_id)
+    # 重复任务按 from/to 范围（默认当天）展开为各次发生后再统计
+    try:
+        window_start, window_end = parse_window(request.args, default_today=True)
+    except ValueError as e:
+        return jsonify({'detail': str(e)}), 400
+    
+    return coalesced_json('stats', user_id, lambda: compute_stats(user_id, window_start, window_end),
+                          window_start=window_start, window_end=window_end)
+
+def compute_stats(user_id, window_start, window_end):
+    """计算统计信息（重复任务在窗口内展开）"""
+    all_todos = TodoModel.get_todos_by_user(user_id, window_start=window_start, window_end=window_end)
     completed_todos = [t for t in all_todos if t['completed']]
     pending_todos = [t for t in all_todos if not t['completed']]
     
@@ -188,20 +477,113 @@ def get_stats():
         'low': len([t for t in pending_todos if t['priority'] == 'low'])
     }
     
-    # 过期任务统计
+    # 过期任务统计：非重复任务在部分索引上计数，只有展开出的发生在内存中判断
     now = datetime.now().isoformat()
-    overdue_todos = [
-        t for t in pending_todos 
-        if t['due_date'] and t['due_date'] < now
-    ]
+    overdue = TodoModel.count_overdue(user_id, now) + len([
+        t for t in pending_todos
+        if t.get('virtual') and t['due_date'] and t['due_date'] < now
+    ])
+    
+    # 已归档的todo都是已完成的，计入总数和完成数
+    archived = ArchiveModel.count_archived(user_id)
+    total = len(all_todos) + archived
+    completed = len(completed_todos) + archived
     
     stats = {
-        'total': len(all_todos),
-        'completed': len(completed_todos),
+        'total': total,
+        'completed': completed,
         'pending': len(pending_todos),
-        'overdue': len(overdue_todos),
-        'completion_rate': round(len(completed_todos) / len(all_todos) * 100, 1) if all_todos else 0,
+        'overdue': overdue,
+        'archived': archived,
+        'completion_rate': round(completed / total * 100, 1) if total else 0,
         'priority_stats': priority_stats
     }
     
-    return jsonify(stats)
\ No newline at end of file
+    return stats
+
+def parse_due_limit(args):
+    """解析到期列表的 limit 参数（默认100，最大1000），不合法时抛出 ValueError"""
+    limit = int(args.get('limit', 100))
+    if not 1 <= limit <= 1000:
+        raise ValueError('limit 必须在 1 到 1000 之间')
+    return limit
+
+@todo_bp.route('/upcoming', methods=['GET'])
+@token_required
+def get_upcoming():
+    """获取接下来 hours 小时内（默认24）到期的未完成任务，按截止时间排序"""
+    user_id = request.current_user['user_id']
+    try:
+        hours = float(request.args.get('hours', 24))
+        limit = parse_due_limit(request.args)
+    except ValueError:
+        return jsonify({'detail': 'hours 和 limit 必须是合法的数字'}), 400
+    if not 0 < hours <= MAX_WINDOW_DAYS * 24:
+        return jsonify({'detail': f'hours 必须在 0 到 {MAX_WINDOW_DAYS * 24} 之间'}), 400
+    
+    now = datetime.now()
+    todos = TodoModel.get_due_todos(
+        user_id,
+        due_from=now.isoformat(timespec='seconds'),
+        due_before=(now + timedelta(hours=hours)).isoformat(timespec='seconds'),
+        limit=limit
+    )
+    return jsonify(todos)
+
+@todo_bp.route('/overdue', methods=['GET'])
+@token_required
+def get_overdue():
+    """获取已过截止时间的未完成任务（重复任务只包括当天的发生），按截止时间排序"""
+    user_id = request.current_user['user_id']
+    try:
+        limit = parse_due_limit(request.args)
+    except ValueError:
+        return jsonify({'detail': 'limit 必须在 1 到 1000 之间'}), 400
+    
+    todos = TodoModel.get_due_todos(
+        user_id, due_before=datetime.now().isoformat(timespec='seconds'), limit=limit
+    )
+    return jsonify(todos)
+
+@todo_bp.route('/stats/history', methods=['GET'])
+@token_required
+def get_stats_history():
+    """获取创建/完成/删除的历史趋势（from/to 默认最近90天，granularity 为 day/week/month）"""
+    user_id = request.current_user['user_id']
+    granularity = request.args.get('granularity', 'day')
+    
+    if granularity not in GRANULARITIES:
+        return jsonify({'detail': '粒度必须是 day, week 或 month'}), 400
+    
+    start, end = default_history_window()
+    try:
+        if request.args.get('from'):
+            start = parse_date(request.args['from'])
+        if request.args.get('to'):
+            end = parse_date(request.args['to'])
+    except ValueError as e:
+        return jsonify({'detail': str(e)}), 400
+    
+    if start > end:
+        return jsonify({'detail': 'from 不能晚于 to'}), 400
+    if (end - start).days > MAX_HISTORY_DAYS:
+        return jsonify({'detail': f'日期范围不能超过 {MAX_HISTORY_DAYS} 天'}), 400
+    
+    return jsonify({
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'granularity': granularity,
+        'series': HistoryModel.get_history(user_id, start, end, granularity)
+    })
+
+@todo_bp.route('/cache/stats', methods=['GET'])
+@admin_required
+def get_cache_stats():
+    """获取查询结果缓存的命中率和内存统计（全局数据，需要 X-Admin-Token）"""
+    return jsonify(query_cache.stats())
+
+@todo_bp.route('/coalescing/stats', methods=['GET'])
+@admin_required
+def get_coalescing_stats():
+    """获取并发相同读请求的合并统计（全局数据，需要 X-Admin-Token）"""
+    return jsonify(single_flight.stats())
\ No newline at end of file
@@ -0,0 +1,387 @@
+"""轻量级请求追踪
+
+每个请求一个trace，trace id 从请求头 traceparent（W3C Trace Context）继承，没有时随机生成；
+是否采样按 TRACE_SAMPLE_RATE 决定（TRACE_TRUST_PARENT=1 时信任上游的采样标志）。请求内的认证、数据库连接、每条SQL、序列化、bcrypt 等
+记录为嵌套的span，采样到的trace以 OTLP-JSON 格式追加写入本地文件（每行一个导出请求）。
+
+未被采样的请求只多一次 contextvars 查询，span() 直接返回 None。
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+# 新trace的采样率（0~1）
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+# 是否信任请求头 traceparent 中的采样标志；默认不信任，否则任何客户端都能强制记录全部请求
+# （包括SQL语句），只在前面有可信网关时开启。不信任时仍沿用上游的 trace id，是否采样由本地决定
+TRACE_TRUST_PARENT = os.environ.get('TRACE_TRUST_PARENT', '0') == '1'
+TRACE_EXPORT_PATH = os.environ.get(
+    'TRACE_EXPORT_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'traces', 'traces.otlp.jsonl')
+)
+# 内存中最多缓冲的span数，写文件跟不上时丢弃最早的span
+TRACE_BUFFER_SPANS = int(os.environ.get('TRACE_BUFFER_SPANS', 4096))
+TRACE_FLUSH_SECONDS = float(os.environ.get('TRACE_FLUSH_SECONDS', 5))
+# 导出文件超过该大小时轮转为 .1、.2 ...，最多保留 TRACE_EXPORT_BACKUPS 个旧文件
+TRACE_EXPORT_MAX_BYTES = int(os.environ.get('TRACE_EXPORT_MAX_BYTES', 64 * 1024 * 1024))
+TRACE_EXPORT_BACKUPS = int(os.environ.get('TRACE_EXPORT_BACKUPS', 3))
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'todo-backend')
+# SQL语句记录的最大长度
+MAX_STATEMENT_LENGTH = 500
+
+# OTLP span kind
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+_current_span = ContextVar('current_span', default=None)
+
+class Span:
+    """一个计时区间"""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'kind', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, trace_id, parent_id=None, kind=SPAN_KIND_INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.error = f'{type(error).__name__}: {error}'
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            exporter.add(self)
+
+    @property
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def to_otlp(span):
+    """转换为 OTLP-JSON 的 span 对象"""
+    data = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': span.kind,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in span.attributes.items()],
+        'status': {'code': 2, 'message': span.error} if span.error else {'code': 0},
+    }
+    if span.parent_id:
+        data['parentSpanId'] = span.parent_id
+    return data
+
+class FileExporter:
+    """有界缓冲 + 后台线程批量写入 OTLP-JSON 文件"""
+
+    def __init__(self, path=TRACE_EXPORT_PATH, max_spans=TRACE_BUFFER_SPANS, interval=TRACE_FLUSH_SECONDS,
+                 max_bytes=TRACE_EXPORT_MAX_BYTES, backups=TRACE_EXPORT_BACKUPS):
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._buffer = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.exported = 0
+        self.dropped = 0
+
+    def add(self, span):
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(span)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"写入追踪数据出错: {e}")
+
+    def flush(self):
+        """把缓冲中的span写入文件，返回写入数量"""
+        with self._lock:
+            spans = list(self._buffer)
+            self._buffer.clear()
+        if not spans:
+            return 0
+        request = {
+            'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': _otlp_value(TRACE_SERVICE_NAME)}]},
+                'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': [to_otlp(s) for s in spans]}],
+            }]
+        }
+        line = (json.dumps(request, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._write_lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                size = 0
+            if size and size + len(line) > self.max_bytes:
+                self._rotate()
+            with open(self.path, 'ab') as f:
+                f.write(line)
+        self.exported += len(spans)
+        return len(spans)
+
+    def _rotate(self):
+        """path -> path.1 -> path.2 ...，超出保留数量的最旧文件被删除（调用方持有写锁）"""
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        os.replace(self.path, f'{self.path}.1')
+
+exporter = FileExporter()
+
+def parse_traceparent(header):
+    """解析 traceparent 请求头，返回 (trace_id, parent_span_id, sampled)，不合法时返回 None"""
+    if not header:
+        return None
+    parts = header.strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or parts[0] == 'ff':
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16), int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None
+    return parts[1], parts[2], bool(int(parts[3], 16) & 1)
+
+def start_trace(name, traceparent=None, attributes=None):
+    """开始一个请求的根span，未采样时返回 None；返回值需要传给 end_trace"""
+    parent = parse_traceparent(traceparent)
+    trace_id, parent_id, sampled = parent if parent else (None, None, False)
+    if not (sampled and TRACE_TRUST_PARENT):
+        sampled = TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+    if not sampled:
+        return None
+    span = Span(name, trace_id or os.urandom(16).hex(), parent_id, SPAN_KIND_SERVER, attributes)
+    return span, _current_span.set(span)
+
+def end_trace(trace, status_code=None, error=None):
+    if trace is None:
+        return
+    span, token = trace
+    if status_code is not None:
+        span.set('http.status_code', status_code)
+        if status_code >= 500:
+            span.error = span.error or f'HTTP {status_code}'
+    if error is not None:
+        span.record_error(error)
+    span.end()
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        # 在其他上下文中结束（如流式响应），直接清除
+        _current_span.set(None)
+
+def current_span():
+    return _current_span.get()
+
+def start_span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    """在当前trace中开始一个不改变当前span的子span（需要手动 end），未采样时返回 None"""
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return Span(name, parent.trace_id, parent.span_id, kind, attributes)
+
+@contextmanager
+def span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    """在当前trace中记录一个嵌套span，未采样时 yield None"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent.span_id, kind, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+def traced(name):
+    """把函数调用记录为span的装饰器"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return f(*args, **kwargs)
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _statement(sql):
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= MAX_STATEMENT_LENGTH else sql[:MAX_STATEMENT_LENGTH] + '...'
+
+class TracedCursor(sqlite3.Cursor):
+    """每条SQL记录为一个span的游标"""
+
+    def execute(self, sql, parameters=()):
+        if _current_span.get() is None:
+            return super().execute(sql, parameters)
+        with span('sqlite.execute', SPAN_KIND_CLIENT, **{'db.system': 'sqlite', 'db.statement': _statement(sql)}):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if _current_span.get() is None:
+            return super().executemany(sql, seq_of_parameters)
+        with span('sqlite.executemany', SPAN_KIND_CLIENT, **{'db.system': 'sqlite', 'db.statement': _statement(sql)}):
+            return super().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        if _current_span.get() is None:
+            return super().executescript(sql_script)
+        with span('sqlite.executescript', SPAN_KIND_CLIENT, **{'db.system': 'sqlite', 'db.statement': _statement(sql_script)}):
+            return super().executescript(sql_script)
+
+    def fetchall(self):
+        if _current_span.get() is None:
+            return super().fetchall()
+        with span('sqlite.fetchall') as s:
+            rows = super().fetchall()
+            s.set('db.rows', len(rows))
+            return rows
+
+class TracedConnection(sqlite3.Connection):
+    """sqlite3.connect(..., factory=TracedConnection)，语句通过 TracedCursor 执行"""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+def connect(db_path, factory=TracedConnection, **kwargs):
+    """打开带追踪的sqlite连接，连接耗时记录为span（factory 须为 TracedConnection 的子类）"""
+    if _current_span.get() is None:
+        return sqlite3.connect(db_path, factory=factory, **kwargs)
+    with span('sqlite.connect', **{'db.system': 'sqlite', 'db.name': os.path.basename(db_path)}):
+        return sqlite3.connect(db_path, factory=factory, **kwargs)
+
+def init_flask(app):
+    """为Flask应用注册请求追踪和序列化span"""
+    from flask import request, g
+    from flask.json.provider import DefaultJSONProvider
+
+    class TracedJSONProvider(DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            if _current_span.get() is None:
+                return super().dumps(obj, **kwargs)
+            with span('json.serialize'):
+                return super().dumps(obj, **kwargs)
+
+    app.json = TracedJSONProvider(app)
+
+    @app.before_request
+    def start_request_trace():
+        g.trace = start_trace(f'{request.method} {request.url_rule.rule if request.url_rule else request.path}',
+                              request.headers.get('traceparent'),
+                              {'http.method': request.method, 'http.target': request.path})
+
+    @app.after_request
+    def record_response(response):
+        trace = g.get('trace')
+        if trace is not None:
+            trace[0].set('http.status_code', response.status_code)
+            response.headers['traceparent'] = trace[0].traceparent
+        return response
+
+    @app.teardown_request
+    def end_request_trace(error=None):
+        trace = g.pop('trace', None)
+        if trace is not None:
+            end_trace(trace, trace[0].attributes.get('http.status_code', 500 if error else None), error)
+
+def init_fastapi(app):
+    """为FastAPI应用注册请求追踪中间件"""
+
+    @app.middleware('http')
+    async def trace_requests(request, call_next):
+        trace = start_trace(f'{request.method} {request.url.path}', request.headers.get('traceparent'),
+                            {'http.method': request.method, 'http.target': request.url.path})
+        if trace is None:
+            return await call_next(request)
+        try:
+            response = await call_next(request)
+        except Exception as e:
+            end_trace(trace, 500, e)
+            raise
+        response.headers['traceparent'] = trace[0].traceparent
+        end_trace(trace, response.status_code)
+        return response
+
+def instrument_sqlalchemy(engine):
+    """把SQLAlchemy引擎执行的每条SQL记录为span"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        sql_span = start_span('sqlalchemy.execute', SPAN_KIND_CLIENT,
+                              **{'db.system': 'sqlite', 'db.statement': _statement(statement)})
+        if sql_span is not None:
+            conn.info.setdefault('trace_spans', []).append(sql_span)
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get('trace_spans')
+        if spans:
+            spans.pop().end()
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        spans = context.connection.info.get('trace_spans') if context.connection is not None else None
+        if spans:
+            sql_span = spans.pop()
+            sql_span.record_error(context.original_exception)
+            sql_span.end()